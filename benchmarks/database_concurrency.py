@@ -0,0 +1,87 @@
+"""
+Benchmark of concurrent reads and writes on one SQLite file in the default and the
+production database modes (WAL, synchronous=NORMAL, busy timeout and a sized pool).
+
+Each mode gets a fresh temporary database with the same containers, then half of the
+threads update container statuses while the other half list containers by user.
+Run from the repository root:
+
+    python -m benchmarks.database_concurrency --threads 16 --operations 300
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+# The repository modules create their engine on import, so keep it off test.db
+_database_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_database_dir.name}/import.db")
+
+from sqlalchemy import create_engine, event, select, update
+from sqlalchemy.orm import sessionmaker
+from models.base import Base
+from models.container import Container, ContainerStatus
+from repositories import database_repository
+
+CONTAINERS = 1000
+USERS = 50
+
+def mode_sessions(mode: str, url: str) -> sessionmaker:
+    # Build the engine the way database_repository does for the given mode
+    database_repository.DATABASE_MODE = mode
+    engine = create_engine(url, **database_repository.engine_options(url))
+    if mode == "production":
+        event.listen(engine, "connect", database_repository.set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def run_mode(mode: str, threads: int, operations: int):
+    url = f"sqlite:///{_database_dir.name}/{mode}.db"
+    Session = mode_sessions(mode, url)
+    with Session() as db:
+        db.add_all([Container(container_id=f"c{i}", container_name="benchmark", user_id=i % USERS) for i in range(CONTAINERS)])
+        db.commit()
+
+    completed = 0
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(write: bool):
+        nonlocal completed, errors
+        for i in range(operations):
+            db = Session()
+            try:
+                if write:
+                    db.execute(update(Container).where(Container.container_id == f"c{i % CONTAINERS}").values(status=ContainerStatus.running))
+                    db.commit()
+                else:
+                    db.execute(select(Container).where(Container.user_id == i % USERS)).all()
+                with lock:
+                    completed += 1
+            except Exception:
+                with lock:
+                    errors += 1
+            finally:
+                db.close()
+
+    workers = [threading.Thread(target=worker, args=(index % 2 == 0,)) for index in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(f"{mode}: {completed / elapsed:,.0f} ops/s, {errors} errors ({threads // 2} writers, {threads - threads // 2} readers)")
+    Session.kw["bind"].dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--operations", type=int, default=300, help="operations per thread")
+    args = parser.parse_args()
+    for mode in ("default", "production"):
+        run_mode(mode, args.threads, args.operations)
+
+if __name__ == "__main__":
+    main()
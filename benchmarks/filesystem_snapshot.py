@@ -0,0 +1,101 @@
+"""
+Benchmark of the filesystem snapshot against the two `find -exec echo` runs it replaced.
+
+Builds a synthetic tree in a temporary directory and lists it both ways with find run
+locally, or inside a running container with --container (the tree is then taken from
+its /app). Run from the repository root:
+
+    python -m benchmarks.filesystem_snapshot --entries 100000
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+from controllers.docker import FileSystemItem, build_filesystem_items
+from repositories.filesystem_repository import parse_snapshot, snapshot_command
+
+def build_tree(root: str, entries: int, files_per_directory: int = 99):
+    """
+    Create directories of files_per_directory files each until there are entries
+    entries, with a few names containing spaces and newlines.
+    """
+    created = 0
+    directory = 0
+    while created < entries:
+        path = os.path.join(root, f"package {directory}" if directory % 10 == 0 else f"package{directory}")
+        os.mkdir(path)
+        created += 1
+        for index in range(min(files_per_directory, entries - created)):
+            name = f"line\nbreak {index}.js" if index == 0 and directory % 50 == 0 else f"module_{index}.js"
+            with open(os.path.join(path, name), "w") as file:
+                file.write("x" * index)
+            created += 1
+        directory += 1
+
+def old_filesystem_items(run, root: str) -> list[FileSystemItem]:
+    # The implementation before the snapshot: one echo per entry, split on newlines
+    directories_output = run(f"find {root} -type d -exec echo {{}} \\;").decode("utf-8").strip().split("\n")
+    files_output = run(f"find {root} -type f -exec echo {{}} \\;").decode("utf-8").strip().split("\n")
+    files = []
+    for kind, output in (('directory', directories_output), ('file', files_output)):
+        for item in output:
+            item = item.strip()
+            parent_path = '/'.join(item.split('/')[:-1]) or None
+            files.append(FileSystemItem(name=item.split('/')[-1], path=item, parentPath=parent_path, kind=kind, handle=None, content=None, isSaved=True, isOpen=False))
+    return files
+
+def local_runner():
+    def run_old(command: str) -> bytes:
+        return subprocess.run(command, shell=True, capture_output=True, check=True).stdout
+
+    def run_new(root: str):
+        process = subprocess.Popen(snapshot_command(root), stdout=subprocess.PIPE)
+        yield from iter(lambda: process.stdout.read(64 * 1024), b"")
+        process.wait()
+
+    return run_old, run_new
+
+def container_runner(container_id: str):
+    import docker
+    container = docker.from_env().containers.get(container_id)
+
+    def run_old(command: str) -> bytes:
+        return container.exec_run(command, tty=True).output
+
+    def run_new(root: str):
+        exec_result = container.exec_run(snapshot_command(root), stream=True, demux=True)
+        return (stdout for stdout, _ in exec_result.output if stdout)
+
+    return run_old, run_new
+
+def measure(label: str, list_items) -> list[FileSystemItem]:
+    started = time.perf_counter()
+    items = list_items()
+    print(f"{label}: {time.perf_counter() - started:.2f}s for {len(items)} entries")
+    return items
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--container", help="list /app of this running container instead of a local tree")
+    parser.add_argument("--skip-old", action="store_true", help="only time the snapshot")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        if args.container:
+            root = "/app"
+            run_old, run_new = container_runner(args.container)
+        else:
+            root = os.path.join(temporary, "app")
+            os.mkdir(root)
+            build_tree(root, args.entries)
+            run_old, run_new = local_runner()
+        new_items = measure("new: one find -printf run + streaming parse", lambda: build_filesystem_items(parse_snapshot(run_new(root))))
+        if not args.skip_old:
+            old_items = measure("old: two find -exec echo runs + split/strip", lambda: old_filesystem_items(run_old, root))
+            # Names with newlines are split into bogus entries by the old implementation
+            print(f"entries listed: new {len(new_items)}, old {len(old_items)}")
+
+if __name__ == "__main__":
+    main()
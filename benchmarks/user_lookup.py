@@ -0,0 +1,62 @@
+"""
+Benchmark of the authenticated-user lookup: get_current_user with the user cache against
+the verify_token + get_user_by_email query that every handler ran before.
+
+Uses a temporary SQLite database unless DATABASE_URL is set. Run from the repository root:
+
+    python -m benchmarks.user_lookup --calls 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+# The database is chosen when the repository modules are imported
+_database_dir = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_database_dir.name}/benchmark.db")
+
+from controllers.auth import get_current_user, get_token_payload
+from repositories.auth_repository import create_access_token, user_cache, verify_token
+from repositories.database_repository import SessionLocal, create_user, get_user_by_email
+
+def old_lookup(token: str, db):
+    # The implementation before the shared dependency: decode, then query on every request
+    token_payload = verify_token(token)
+    return get_user_by_email(db, token_payload.get('sub'))
+
+def new_lookup(token: str, db):
+    return get_current_user(get_token_payload(token), db)
+
+def measure(label: str, lookup, token: str, calls: int):
+    db = SessionLocal()
+    try:
+        # Warm up the connection pool and, for the new path, the user cache
+        for _ in range(min(calls, 100)):
+            lookup(token, db)
+        started = time.perf_counter()
+        for _ in range(calls):
+            lookup(token, db)
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+    print(f"{label}: {calls / elapsed:,.0f} calls/s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20_000)
+    args = parser.parse_args()
+
+    email = f"benchmark-{time.time_ns()}@example.com"
+    db = SessionLocal()
+    try:
+        create_user(db, email, email, "password")
+    finally:
+        db.close()
+    token = create_access_token({"sub": email})
+
+    measure("old: verify_token + get_user_by_email", old_lookup, token, args.calls)
+    user_cache.invalidate(email)
+    measure("new: get_current_user with the user cache", new_lookup, token, args.calls)
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,31 @@ from sqlalchemy.orm import Session
 from repositories.database_repository import get_db, create_user, get_user_by_email_or_username, get_user_by_email, verify_password
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from repositories.auth_repository import create_access_token, verify_token
+from repositories.auth_repository import CachedUser, create_access_token, user_cache, verify_token
 
 # Create the router instance
 auth_router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Dependency to get the payload of a valid token
+def get_token_payload(token: str = Depends(oauth2_scheme)) -> dict:
+    token_payload = verify_token(token)
+    if token_payload is None:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    return token_payload
+
+# Dependency to get the authenticated user, cached by token subject
+def get_current_user(token_payload: dict = Depends(get_token_payload), db: Session = Depends(get_db)) -> CachedUser:
+    subject = token_payload.get('sub')
+    user = user_cache.get(subject)
+    if user is None:
+        db_user = get_user_by_email(db, subject)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        user = CachedUser(db_user.id, db_user.username, db_user.email)
+        user_cache.put(subject, user, token_payload.get('exp'))
+    return user
+
 class SignupRequest(BaseModel):
     username: str
     email: str
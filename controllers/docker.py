@@ -1,111 +1,287 @@
-import io
-import tarfile
+import gzip
+import mimetypes
+import posixpath
+import time
 import docker
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from models.container import Container
-from repositories.database_repository import get_db, get_user_by_email
-from controllers.auth import oauth2_scheme
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.container import Container, ContainerStatus
+from repositories.database_repository import AsyncSessionLocal, count_user_containers, get_async_db, list_containers_by_owner_email, list_user_containers_page
+from controllers.auth import get_current_user, get_token_payload
 import asyncio
-from typing import Optional
+import codecs
+import json
+from typing import Awaitable, Callable, Iterable, Literal, NamedTuple, Optional
 from fastapi import UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse
 import base64
+import orjson
 
-from repositories.auth_repository import verify_token
+from repositories.auth_repository import CachedUser, ownership_cache, verify_token
+from repositories.connections import connections
+from repositories.docker_hosts import DockerHost, DockerHostUnavailableError, docker_hosts
+from repositories.idle_tracker import idle_tracker
+from repositories.jobs import Job, JobFailedError, jobs
+from repositories.image_repository import DEFAULT_IMAGE
+from repositories.terminal import ExecSocket, OutputCoalescer, TerminalSessionLimitError, terminal_sessions
+from repositories.scheduler import DEFAULT_LIMITS, MAX_CONTAINER_CPUS, MAX_CONTAINER_MEMORY, CapacityExceededError, QuotaExceededError, Reservation, ResourceLimits, scheduler
+from repositories.file_agent import FileAgentError, close_file_agent, read_file_content, read_file_version, run_file_operation, stat_file
+from repositories.filesystem_repository import FileEntry, FileUpload, apply_text_edits, iter_file_content, open_file, scan_directory, scan_filesystem, stat_paths, write_files
+from repositories.filesystem_watch import filesystem_watch
+from repositories.filesystem_cache import FileSystemTree, content_hash, file_content_cache, filesystem_cache, listing_key, normalize_path
 
 docker_router = APIRouter()
 
-client = docker.from_env()
+class OwnedContainer(NamedTuple):
+    id: int
+    container_id: str
+    user_id: int
+    owner_email: str
+    docker_host: Optional[str]
+
+async def resolve_owned_container(db: AsyncSession, token_payload: dict, container_id: str) -> OwnedContainer:
+    """
+    Check that the token subject owns the container with a single join, caching positive results briefly.
+    The query goes through the async session, so a cache miss does not block the event loop.
+    """
+    subject = token_payload.get('sub')
+    container = ownership_cache.get((subject, container_id))
+    if container is None:
+        rows = await list_containers_by_owner_email(db, subject, [container_id])
+        if not rows:
+            raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
+        container = OwnedContainer(*rows[0])
+        ownership_cache.put((subject, container_id), container, token_payload.get('exp'))
+    return container
+
+def container_host(container: OwnedContainer) -> DockerHost:
+    """
+    Return the Docker host the container was placed on.
+    """
+    try:
+        return docker_hosts.get(container.docker_host)
+    except DockerHostUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+# Dependency to get a container from the path that belongs to the authenticated user
+async def get_owned_container(container_id: str, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)) -> OwnedContainer:
+    return await resolve_owned_container(db, token_payload, container_id)
+
+async def resume_container(container_id: str):
+    """
+    Record activity on a container and wait for it if it was suspended while idle.
+    """
+    try:
+        await idle_tracker.ensure_active(container_id)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Container is resuming, try again shortly")
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail="Docker container not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error resuming container: {str(e)}")
+
+# Dependency to get an owned container, resumed if it was suspended while idle
+async def get_active_container(container: OwnedContainer = Depends(get_owned_container)) -> OwnedContainer:
+    await resume_container(container.container_id)
+    return container
 
 class StartContainerRequest(BaseModel):
     user_mail: str
     token: str
 
-@docker_router.post("/docker/create-container")
-def create_container(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def job_response(job: Job) -> JSONResponse:
     """
-    Start a Docker container with the specified image.
-    :param image_name: The name of the Docker image to use (e.g., "nginx", "ubuntu")
+    202 response pointing to the status and event stream of a background job.
     """
+    status_url = f"/docker/jobs/{job.id}"
+    return JSONResponse(status_code=202, headers={"Location": status_url}, content={"job_id": job.id, "status": job.status, "status_url": status_url, "events_url": f"{status_url}/events"})
+
+def submit_job(owner: str, operation: str, work: Callable[[Job], Awaitable[dict]], idempotency_key: Optional[str]) -> JSONResponse:
+    """
+    Run work(job) as a background job of the owner, reporting HTTP errors as the job error.
+    """
+    async def run(job: Job) -> dict:
+        try:
+            return await work(job)
+        except HTTPException as e:
+            raise JobFailedError(e.status_code, e.detail)
+
+    return job_response(jobs.submit(owner, operation, run, idempotency_key))
+
+async def create_user_container(db: AsyncSession, user: CachedUser, limits: ResourceLimits, progress: Callable[[str], None] = print) -> dict:
     try:
-        print(token)
-        payload = verify_token(token)
-
-        if payload == None: 
-            return {"message": "Invalid credentials"}
-
-        IMAGE_NAME = "javierhersan/code-ai"
-        print(f"Starting container with image: {IMAGE_NAME}")
-        # Pull the image if not available locally
-        client.images.pull(IMAGE_NAME)
-        # Start a container with the image
-        container = client.containers.create(IMAGE_NAME)
-        # container = client.containers.run(IMAGE_NAME, detach=True)
-
-        user = get_user_by_email(db, payload.get('sub'))
-        if user:
+        IMAGE_NAME = DEFAULT_IMAGE
+        progress(f"Starting container with image: {IMAGE_NAME}")
+
+        async def create(status: ContainerStatus, host_name: str) -> Container:
+            host = docker_hosts.get(host_name)
+            # Hand out a pre-created container when one is ready with the same limits
+            if status == ContainerStatus.created and limits == DEFAULT_LIMITS:
+                pooled = await host.warm_pool.claim(db, user.id)
+                if pooled is not None:
+                    progress(f"Claimed a pre-created container on {host_name}")
+                    return pooled
+
+            # Pull the image only if not available locally, stale copies refresh in the background
+            progress(f"Preparing image on {host_name}")
+            await host.images.ensure(IMAGE_NAME)
+            # Start a container with the image
+            progress(f"Creating container on {host_name}")
+            client = await host.engine.get_client()
+            container = await host.engine.run(client.containers.create, IMAGE_NAME, **limits.docker_options(), operation="create")
+            # container = client.containers.run(IMAGE_NAME, detach=True)
+
             new_container = Container(
                 container_id=container.id, 
                 container_name=IMAGE_NAME, 
                 user_id=user.id,
-                status=container.status
+                status=status if status == ContainerStatus.queued else container.status,
+                docker_host=host_name,
+                cpu_limit=limits.cpus,
+                memory_limit=limits.memory
             )
             db.add(new_container)
-            db.commit()
-            db.refresh(new_container)
+            try:
+                await db.commit()
+            except Exception:
+                # Do not leave a Docker container behind that no row accounts for
+                await db.rollback()
+                await host.engine.run(container.remove, force=True, operation="remove")
+                raise
+            await db.refresh(new_container)
+            return new_container
+
+        new_container = await scheduler.admit(db, user.id, limits, docker_hosts.placeable(), create)
+        idle_tracker.touch(new_container.container_id)
 
-        return {"id":new_container.id, "container_id": new_container.id, "container_id": container.id, "container_name": IMAGE_NAME, "user_id":user.id, "status": container.status}
+        return {"id": new_container.id, "container_id": new_container.container_id, "container_name": IMAGE_NAME, "user_id": user.id, "status": new_container.status.value, "cpu_limit": new_container.cpu_limit, "memory_limit": new_container.memory_limit, "docker_host": new_container.docker_host}
     
     except docker.errors.ImageNotFound:
         raise HTTPException(status_code=404, detail=f"Docker image {IMAGE_NAME} not found.")
     
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+    except CapacityExceededError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error starting container: {str(e)}")
 
+@docker_router.post("/docker/create-container")
+async def create_container(cpus: Optional[float] = Query(None, gt=0, le=MAX_CONTAINER_CPUS), memory_mb: Optional[int] = Query(None, gt=0, le=MAX_CONTAINER_MEMORY // 1024 ** 2), background: bool = False, idempotency_key: Optional[str] = Header(None), user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """
+    Start a Docker container with the specified image.
+    :param image_name: The name of the Docker image to use (e.g., "nginx", "ubuntu")
+    :param cpus: CPU cores the container may use, the default limit when omitted
+    :param memory_mb: Memory the container may use in MiB, the default limit when omitted
+    :param background: Return a job at once with status 202 and create the container in
+    the background. Retries with the same Idempotency-Key header get the same job.
+    The container is placed on a healthy Docker host, and queued with status "queued"
+    while that host has no capacity for it.
+    """
+    limits = ResourceLimits(
+        cpus if cpus is not None else DEFAULT_LIMITS.cpus,
+        memory_mb * 1024 ** 2 if memory_mb is not None else DEFAULT_LIMITS.memory,
+    )
+    if background:
+        async def work(job: Job) -> dict:
+            async with AsyncSessionLocal() as job_db:
+                return await create_user_container(job_db, user, limits, job.progress)
+
+        return submit_job(user.email, "create-container", work, idempotency_key)
+    return await create_user_container(db, user, limits)
+
+# Page sizes for the user containers listing
+DEFAULT_CONTAINER_LISTING_LIMIT = 500
+MAX_CONTAINER_LISTING_LIMIT = 1000
+
 @docker_router.get("/docker/user-containers")
-def list_user_containers(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def list_user_containers(limit: int = Query(DEFAULT_CONTAINER_LISTING_LIMIT, ge=1, le=MAX_CONTAINER_LISTING_LIMIT), cursor: Optional[int] = None, status: Optional[ContainerStatus] = None, include_total: bool = True, user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
-    List all containers associated with a user.
+    List the containers associated with a user in id order, optionally with a given status.
+    Pass next_cursor from the previous page as cursor to get the next one; it is None on
+    the last page. Set include_total to false to skip counting all matching containers.
     """
-    token_payload = verify_token(token)
-    
-    if token_payload == None: 
-        return {"message": "Invalid credentials"}
-    
-    user = token_payload.get('sub')
-    
-    user = get_user_by_email(db, user)
-    if user:
-        containers = db.query(Container).filter(Container.user_id == user.id).all()
-        return {"containers": containers}
-    else:
-        raise HTTPException(status_code=404, detail="User not found.")
+    rows = await list_user_containers_page(db, user.id, limit + 1, cursor, status)
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    containers = [
+        {"id": row.id, "container_id": row.container_id, "container_name": row.container_name, "user_id": row.user_id, "status": row.status.value, "cpu_limit": row.cpu_limit, "memory_limit": row.memory_limit, "docker_host": row.docker_host}
+        for row in rows[:limit]
+    ]
+    result = {"containers": containers, "next_cursor": next_cursor}
+    if include_total:
+        result["total"] = await count_user_containers(db, user.id, status)
+    return result
+
+@docker_router.get("/docker/warm-pool")
+async def get_warm_pool_stats(token_payload: dict = Depends(get_token_payload)):
+    """
+    Warm pool size and hit/miss counters of each Docker host.
+    """
+    return [host.warm_pool.stats() for host in docker_hosts.hosts.values()]
+
+@docker_router.get("/docker/hosts")
+async def get_docker_hosts(token_payload: dict = Depends(get_token_payload)):
+    """
+    Docker hosts with their health and the capacity they report.
+    """
+    return [
+        {"name": host.name, "healthy": host.healthy, "capacity": scheduler.capacity[host.name]._asdict() if host.name in scheduler.capacity else None}
+        for host in docker_hosts.hosts.values()
+    ]
+
+async def stop_docker_container(container: OwnedContainer):
+    host = container_host(container)
+    docker_container = await host.engine.get_container(container.container_id)
+    close_file_agent(container.container_id)
+    terminal_sessions.close_container(container.container_id)
+    await host.engine.run(docker_container.stop, operation="stop")
+    host.events.statuses.set(container.container_id, 'exited')
+    idle_tracker.forget(container.container_id)
+    scheduler.wake()
+
+async def start_docker_container(container: OwnedContainer) -> Optional[Reservation]:
+    """
+    Start a container, returning the scheduler reservation to release once its
+    running status is committed.
+    """
+    host = container_host(container)
+    # Unpause a workspace suspended while idle before starting it
+    await idle_tracker.ensure_active(container.container_id)
+    reservation = await scheduler.admit_start(container.container_id)
+    try:
+        docker_container = await host.engine.get_container(container.container_id)
+        await host.engine.run(docker_container.start, operation="start")
+    except Exception:
+        scheduler.release(reservation)
+        raise
+    host.events.statuses.set(container.container_id, 'running')
+    return reservation
+
+async def remove_docker_container(container: OwnedContainer):
+    host = container_host(container)
+    # Bulk deletes kill the container instead of waiting for a graceful stop
+    close_file_agent(container.container_id)
+    terminal_sessions.close_container(container.container_id)
+    try:
+        docker_container = await host.engine.get_container(container.container_id)
+        await host.engine.run(docker_container.remove, force=True, operation="remove")
+    except docker.errors.NotFound:
+        # Already gone, only the record is left
+        pass
+    idle_tracker.forget(container.container_id)
+    scheduler.wake()
 
 @docker_router.put("/docker/stop-container/{container_id}")
-def stop_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def stop_user_container(container_id: str, container: OwnedContainer = Depends(get_owned_container), db: AsyncSession = Depends(get_async_db)):
     try:
-        docker_container = client.containers.get(container.container_id)
-        docker_container.stop()
+        await stop_docker_container(container)
         
-        container.status = 'exited'
-        db.commit()
-        db.refresh(container)
+        await db.execute(update(Container).where(Container.id == container.id).values(status=ContainerStatus.exited))
+        await db.commit()
         
         return {"message": "Container deleted successfully"}
     except docker.errors.NotFound:
@@ -114,63 +290,41 @@ def stop_user_container(container_id: str, token: str = Depends(oauth2_scheme),
         raise HTTPException(status_code=500, detail=f"Error deleting container: {str(e)}")
     
 @docker_router.put("/docker/start-container/{container_id}")
-def start_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def start_user_container(container_id: str, container: OwnedContainer = Depends(get_owned_container), db: AsyncSession = Depends(get_async_db)):
     try:
-        docker_container = client.containers.get(container.container_id)
-        docker_container.start()
-        
-        container.status = 'running'
-        db.commit()
-        db.refresh(container)
+        reservation = await start_docker_container(container)
+        try:
+            await db.execute(update(Container).where(Container.id == container.id).values(status=ContainerStatus.running))
+            await db.commit()
+        finally:
+            scheduler.release(reservation)
         
         return {"message": "Container deleted successfully"}
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except CapacityExceededError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting container: {str(e)}")
 
-@docker_router.delete("/docker/delete-container/{container_id}")
-def delete_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """
-    Delete a Docker container associated with a user.
-    """
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def delete_owned_container(db: AsyncSession, container: OwnedContainer, progress: Callable[[str], None] = print) -> dict:
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
-        docker_container.stop()
-        docker_container.remove()
+        docker_container = await host.engine.get_container(container.container_id)
+        close_file_agent(container.container_id)
+        terminal_sessions.close_container(container.container_id)
+        progress("Stopping container")
+        await host.engine.run(docker_container.stop, operation="stop")
+        progress("Removing container")
+        await host.engine.run(docker_container.remove, operation="remove")
+        idle_tracker.forget(container.container_id)
         
-        db.delete(container)
-        db.commit()
+        await db.execute(delete(Container).where(Container.id == container.id))
+        await db.commit()
+        ownership_cache.invalidate((container.owner_email, container.container_id))
+        scheduler.wake()
         
         return {"message": "Container deleted successfully"}
     except docker.errors.NotFound:
@@ -178,75 +332,235 @@ def delete_user_container(container_id: str, token: str = Depends(oauth2_scheme)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting container: {str(e)}")
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+@docker_router.delete("/docker/delete-container/{container_id}")
+async def delete_user_container(container_id: str, background: bool = False, idempotency_key: Optional[str] = Header(None), container: OwnedContainer = Depends(get_owned_container), db: AsyncSession = Depends(get_async_db)):
+    """
+    Delete a Docker container associated with a user.
+    With background, return a job at once with status 202 and delete it in the background.
+    """
+    if background:
+        async def work(job: Job) -> dict:
+            async with AsyncSessionLocal() as job_db:
+                return await delete_owned_container(job_db, container, job.progress)
+
+        return submit_job(container.owner_email, "delete-container", work, idempotency_key)
+    return await delete_owned_container(db, container)
+
+# Seconds between keepalive comments on idle job event streams
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+
+def get_owned_job(job_id: str, token_payload: dict = Depends(get_token_payload)) -> Job:
+    job = jobs.get(job_id, token_payload.get('sub'))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@docker_router.get("/docker/jobs/{job_id}")
+async def get_job(job: Job = Depends(get_owned_job)):
+    """
+    Status, progress steps and result or error of a background job.
+    """
+    return job.to_dict()
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+async def iter_job_events(job: Job, sent: int):
+    while True:
+        version = job.version
+        for index in range(sent, len(job.steps)):
+            yield f"id: {index + 1}\nevent: progress\ndata: {json.dumps(job.steps[index])}\n\n"
+        sent = len(job.steps)
+        if job.finished:
+            yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+            return
+        if not await job.wait_changed(version, JOB_EVENTS_KEEPALIVE_SECONDS):
+            yield ": keepalive\n\n"
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+@docker_router.get("/docker/jobs/{job_id}/events")
+async def stream_job_events(job: Job = Depends(get_owned_job), last_event_id: Optional[int] = Header(None)):
+    """
+    Server-sent events with each progress step of a job, then a final "succeeded" or
+    "failed" event with the whole job. Reconnecting clients resume after Last-Event-ID.
+    """
+    return StreamingResponse(iter_job_events(job, last_event_id or 0), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+# Bulk lifecycle limits: containers per request and Docker operations run at once
+MAX_BULK_CONTAINERS = 200
+BULK_OPERATION_CONCURRENCY = 8
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+class BulkContainerRequest(BaseModel):
+    container_ids: list[str]
 
-manager = ConnectionManager()
+async def run_bulk_operation(db: AsyncSession, token_payload: dict, container_ids: list[str], operation) -> tuple[list[dict], list[OwnedContainer]]:
+    """
+    Run a lifecycle operation on the user's containers, at most BULK_OPERATION_CONCURRENCY
+    at a time. Returns one result per container id and the containers it succeeded on.
+    """
+    container_ids = list(dict.fromkeys(container_ids))
+    if len(container_ids) > MAX_BULK_CONTAINERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_CONTAINERS} containers per request")
+    owned = {row.container_id: OwnedContainer(*row) for row in await list_containers_by_owner_email(db, token_payload.get('sub'), container_ids)} if container_ids else {}
+    semaphore = asyncio.Semaphore(BULK_OPERATION_CONCURRENCY)
+
+    async def run(container_id: str) -> dict:
+        if container_id not in owned:
+            return {"container_id": container_id, "success": False, "error": "Container not found or does not belong to the user"}
+        async with semaphore:
+            try:
+                await operation(owned[container_id])
+                return {"container_id": container_id, "success": True, "error": None}
+            except docker.errors.NotFound:
+                return {"container_id": container_id, "success": False, "error": "Docker container not found"}
+            except Exception as e:
+                return {"container_id": container_id, "success": False, "error": str(e)}
+
+    results = await asyncio.gather(*(run(container_id) for container_id in container_ids))
+    return results, [owned[result["container_id"]] for result in results if result["success"]]
+
+@docker_router.put("/docker/stop-containers")
+async def stop_user_containers(req: BulkContainerRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    """
+    Stop many containers of the user. Returns one result per container.
+    """
+    results, stopped = await run_bulk_operation(db, token_payload, req.container_ids, stop_docker_container)
+    if stopped:
+        await db.execute(update(Container).where(Container.id.in_([container.id for container in stopped])).values(status=ContainerStatus.exited))
+        await db.commit()
+    return {"containers": results}
+
+@docker_router.put("/docker/start-containers")
+async def start_user_containers(req: BulkContainerRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    """
+    Start many containers of the user. Returns one result per container. Capacity is
+    reserved in memory while the containers start, and all statuses are saved in one
+    transaction at the end.
+    """
+    reservations = []
+
+    async def start(container: OwnedContainer):
+        reservations.append(await start_docker_container(container))
+
+    results, started = await run_bulk_operation(db, token_payload, req.container_ids, start)
+    try:
+        if started:
+            await db.execute(update(Container).where(Container.id.in_([container.id for container in started])).values(status=ContainerStatus.running))
+            await db.commit()
+    finally:
+        for reservation in reservations:
+            scheduler.release(reservation)
+    return {"containers": results}
+
+@docker_router.post("/docker/delete-containers")
+async def delete_user_containers(req: BulkContainerRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    """
+    Delete many containers of the user. Containers are killed rather than stopped
+    gracefully. Returns one result per container.
+    """
+    results, removed = await run_bulk_operation(db, token_payload, req.container_ids, remove_docker_container)
+    if removed:
+        await db.execute(delete(Container).where(Container.id.in_([container.id for container in removed])))
+        await db.commit()
+        for container in removed:
+            ownership_cache.invalidate((container.owner_email, container.container_id))
+    return {"containers": results}
+
+@docker_router.get("/docker/connections")
+async def get_connection_stats(token_payload: dict = Depends(get_token_payload)):
+    """
+    Open websocket counts and slow consumer counters.
+    """
+    return {**connections.stats(), "filesystem_watch": filesystem_watch.stats()}
+
+@docker_router.get("/docker/terminal-sessions/{container_id}")
+async def list_terminal_sessions(container_id: str, container: OwnedContainer = Depends(get_owned_container)):
+    """
+    Terminal sessions of the container, with their viewers and output offsets.
+    """
+    return [session.info() for session in terminal_sessions.list(container.container_id)]
 
 @docker_router.websocket("/docker-ws/{container_id}")
-async def websocket_endpoint(websocket: WebSocket, container_id: str):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, container_id: str, token: str, binary: bool = False, session: str = Query("default", max_length=64), offset: Optional[int] = Query(None, ge=0), db: AsyncSession = Depends(get_async_db)):
+    """
+    Interactive shell in a container of the token's user. Output is sent as UTF-8 text messages, or as raw
+    binary messages with binary=true. Input may be sent as text or binary messages.
+    Connections with the same session id share one shell, which keeps running for a
+    grace period after the last one closes. On attach the scrollback after offset, or
+    all of it, is sent first; binary clients can count bytes to resume where they left off.
+    """
+    token_payload = verify_token(token)
+    if token_payload is None:
+        await websocket.close(code=1008, reason="Invalid credentials")
+        return
+    try:
+        row = await resolve_owned_container(db, token_payload, container_id)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    connection = await connections.connect(websocket, container_id, row.user_id)
+    terminal_session = None
+    viewer = None
+    send_task = None
     try:
-        container = client.containers.get(container_id) 
-        exec_instance = container.exec_run("/bin/sh", stdin=True, stdout=True, stderr=True, tty=True, detach=False, stream=True, socket=True)
-        output_stream = exec_instance.output
+        await idle_tracker.ensure_active(container_id)
         data = ''
+        # Characters split across reads are completed by the next one
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
 
-        async def read_from_container():
-            try:
-                print("Starting to read from container")
-                while True:
-                    output = await asyncio.to_thread(output_stream.recv, 4096)
-                    if not output:
-                        break
-                    decoded_output = output.decode('utf-8')
-                    print("Output of container: ", decoded_output)
-                    print("Data: ", data.strip())
-                    if decoded_output.strip() != data.strip():
-                        await websocket.send_text(decoded_output)
-            except Exception as e:
-                print(f"Error reading from container: {e}")
+        async def send_output(output: bytes):
+            if binary:
+                await connection.send(output)
+                return
+            decoded_output = decoder.decode(output)
+            # Skip output that only echoes the last input back
+            if decoded_output and decoded_output.strip() != data.strip():
+                await connection.send(decoded_output)
 
-        async def write_to_container(input_data):
-            try:
-                print("Writing to container: ", input_data)
-                await asyncio.to_thread(exec_instance.output.send, input_data.encode('utf-8'))
-            except Exception as e:
-                print(f"Error writing to container: {e}")
+        async def open_exec() -> ExecSocket:
+            host = docker_hosts.get(row.docker_host)
+            container = await host.engine.get_container(container_id)
+            exec_instance = await host.engine.run(container.exec_run, "/bin/sh", stdin=True, stdout=True, stderr=True, tty=True, detach=False, stream=True, socket=True, operation="exec")
+            return ExecSocket(exec_instance.output)
 
-        read_task = asyncio.create_task(read_from_container())
+        async def send_until_closed():
+            await viewer.run()
+            # The shell ended or this client fell too far behind
+            await connection.end()
+
+        viewer = OutputCoalescer(send_output)
+        try:
+            terminal_session = await terminal_sessions.attach(container_id, session, viewer, open_exec, offset, lambda: idle_tracker.touch(container_id))
+        except TerminalSessionLimitError as e:
+            await connection.abort(1013, str(e))
+            return
+        send_task = asyncio.create_task(send_until_closed())
         print("WebSocket connected")
         while True:
-            try:
-                # Receive data from frontend terminal (xterm)
-                data = await websocket.receive_text()
-                # Send the received data to the Docker container
-                await write_to_container(data)
-            except WebSocketDisconnect:
-                manager.disconnect(websocket)
+            # Receive data from frontend terminal (xterm)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
                 break
-
-        # Clean up when WebSocket disconnects
-        read_task.cancel()
+            if message.get("bytes") is not None:
+                data = ''
+                input_data = message["bytes"]
+            else:
+                data = message.get("text") or ''
+                input_data = data.encode('utf-8')
+            await idle_tracker.ensure_active(container_id)
+            # Send the received data to the Docker container
+            try:
+                await terminal_session.send(input_data)
+            except Exception as e:
+                print(f"Error writing to container: {e}")
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
     except Exception as e:
-        await manager.disconnect(websocket)
+        print(f"Terminal error for container {container_id}: {e}")
+    finally:
+        # Clean up when WebSocket disconnects, the shell keeps running for a reconnect
+        if terminal_session is not None:
+            terminal_sessions.detach(terminal_session, viewer)
+        if send_task is not None:
+            send_task.cancel()
+            await asyncio.gather(send_task, return_exceptions=True)
+        connections.disconnect(connection)
 
 class FileSystemItem(BaseModel):
     name: str
@@ -257,233 +571,558 @@ class FileSystemItem(BaseModel):
     content: Optional[str]
     isSaved: bool
     isOpen: bool
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+
+def build_filesystem_items(entries: Iterable[FileEntry]) -> list[FileSystemItem]:
+    """
+    Convert snapshot entries to FileSystemItems, directories first.
+    """
+    directories = []
+    files = []
+    for entry in entries:
+        parent_path, _, name = entry.path.rpartition('/')
+        item = FileSystemItem(
+            name=name,
+            path=entry.path,
+            parentPath=parent_path or None,
+            kind=entry.kind,
+            handle=None,
+            content=None,
+            isSaved=True,
+            isOpen=False,
+            size=entry.size,
+            mtime=entry.mtime
+        )
+        (directories if entry.kind == 'directory' else files).append(item)
+    return directories + files
+
+def encode_filesystem_items(entries: Iterable[FileEntry]) -> bytes:
+    return orjson.dumps([item.model_dump() for item in build_filesystem_items(entries)])
+
+async def filesystem_items_response(entries: Iterable[FileEntry], headers: dict) -> Response:
+    # Building and serializing an item per entry takes a while for a large tree, so it
+    # runs off the event loop like the compact format
+    body = await asyncio.to_thread(encode_filesystem_items, entries)
+    return Response(body, media_type="application/json", headers=headers)
+
+# Compact listings are gzip-compressed at this level when the client accepts it
+COMPACT_TREE_GZIP_LEVEL = 5
+
+def build_compact_tree(entries: Iterable[FileEntry], parent_path: Optional[str] = None) -> dict:
+    """
+    Columnar listing with directories first, so the first `directories` entries are
+    directories. `parents` holds the index of the parent of each entry, or -1 for
+    direct children of `parent`. A parent that is not listed, e.g. a directory from an
+    earlier page, is given as -2 - i for its path at `parent_paths[i]`.
+    """
+    directories = []
+    files = []
+    for entry in entries:
+        (directories if entry.kind == 'directory' else files).append(entry)
+    ordered = directories + files
+    index = {entry.path: position for position, entry in enumerate(directories)}
+    # Paths of parents outside the listing, numbered from -2 down in order of appearance
+    unlisted: dict[str, int] = {}
+    names = []
+    parents = []
+    for entry in ordered:
+        parent, _, name = entry.path.rpartition('/')
+        parent = parent or '/'
+        names.append(name)
+        if parent in index:
+            parents.append(index[parent])
+        elif parent == parent_path:
+            parents.append(-1)
+        else:
+            parents.append(unlisted.setdefault(parent, -2 - len(unlisted)))
+    return {
+        "format": "compact",
+        "parent": parent_path,
+        "directories": len(directories),
+        "names": names,
+        "parents": parents,
+        "parent_paths": list(unlisted),
+        "sizes": [entry.size for entry in ordered],
+        "mtimes": [entry.mtime for entry in ordered],
+    }
+
+def encode_compact_tree(entries: Iterable[FileEntry], parent_path: Optional[str], accept_gzip: bool) -> tuple[bytes, Optional[str]]:
+    """
+    Serialize a compact listing, returning the body and its content encoding. The body
+    is always compressed when gzip is accepted, so the encoding follows from the request
+    alone and the ETag can be chosen before the body is built.
+    """
+    body = orjson.dumps(build_compact_tree(entries, parent_path))
+    if accept_gzip:
+        return gzip.compress(body, COMPACT_TREE_GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows gzip, by name or through *, with a q-value above 0.
+    """
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, *params = [part.strip() for part in coding.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+def representation_etag(etag: str, format: str, accept_gzip: bool = False) -> str:
+    # Each format and content encoding is a different representation of the same tree version
+    if format == "items":
+        return etag
+    return f'{etag[:-1]}-{format}-gzip"' if accept_gzip else f'{etag[:-1]}-{format}"'
+
+def compact_accepts_gzip(request: Request, format: str) -> bool:
+    return format == "compact" and accepts_gzip(request.headers.get("accept-encoding", ""))
+
+def not_modified(etag: str, format: str) -> Response:
+    headers = {"ETag": etag}
+    if format == "compact":
+        headers["Vary"] = "Accept-Encoding"
+    return Response(status_code=304, headers=headers)
+
+async def compact_tree_response(entries: Iterable[FileEntry], parent_path: Optional[str], accept_gzip: bool, headers: dict) -> Response:
+    # Encoding a large tree takes a while, so it runs off the event loop
+    body, encoding = await asyncio.to_thread(encode_compact_tree, entries, parent_path, accept_gzip)
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+def load_filesystem(container_id: str, docker_container) -> tuple[str, list[FileEntry]]:
+    """
+    Return the ETag and entries of a container filesystem, scanning only on a cache miss.
+    """
+    cached = filesystem_cache.read(container_id)
+    if cached is not None:
+        return cached
+    tree = FileSystemTree(scan_filesystem(docker_container))
+    if not tree.entries:
+        raise HTTPException(status_code=500, detail="Error retrieving file system structure")
+    filesystem_cache.put(container_id, tree)
+    return tree.etag, list(tree.entries.values())
 
 @docker_router.get("/docker/filesystem/{container_id}")
-def get_filesystem(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def get_filesystem(container_id: str, request: Request, response: Response, format: Literal["items", "compact"] = "items", container: OwnedContainer = Depends(get_active_container)):
+    """
+    The whole workspace tree. format=compact returns the columnar listing of
+    build_compact_tree instead of a list of items, gzip-compressed when accepted.
+    """
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to list all files and directories
-        exec_result_directories = docker_container.exec_run("find /app -type d -exec echo {} \\;", tty=True)
-        exec_result_files = docker_container.exec_run("find /app -type f -exec echo {} \\;", tty=True)
-
-        if exec_result_directories.exit_code != 0 and exec_result_files.exit_code != 0:
-            raise HTTPException(status_code=500, detail="Error retrieving file system structure")
-        
-        directories_output = exec_result_directories.output.decode("utf-8").strip().split("\n")
-        files_output = exec_result_files.output.decode("utf-8").strip().split("\n")
-        
-        files = []
-        for item in directories_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind='directory',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        for item in files_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind= 'file',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        
-        print(files)
-        return files
+        # List all files and directories from the cache or a single find exec
+        etag, entries = await host.engine.run(load_filesystem, container.container_id, docker_container, operation="filesystem")
+        accept_gzip = compact_accepts_gzip(request, format)
+        etag = representation_etag(etag, format, accept_gzip)
+        if request.headers.get("if-none-match") == etag:
+            return not_modified(etag, format)
+        if format == "compact":
+            return await compact_tree_response(entries, None, accept_gzip, {"ETag": etag})
+        return await filesystem_items_response(entries, {"ETag": etag})
 
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file system structure: {str(e)}")
 
-@docker_router.get("/docker/filesystem/{container_id}/{path}")
-def get_container_folder_content(container_id: str, path: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+@docker_router.websocket("/docker-fs-ws/{container_id}")
+async def filesystem_watch_endpoint(websocket: WebSocket, container_id: str, token: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    Changes to the container workspace, as JSON text messages. {"type": "ready"} is sent
+    once the watch is running; clients then load the tree and apply every following
+    {"type": "changes", "events": [...]} batch to it. On {"type": "resync"} the batch was
+    too large to send and the tree has to be loaded again.
 
+    An open watch is not activity: a workspace suspended while idle closes it with 1008
+    and is not resumed by a new one.
+    """
     token_payload = verify_token(token)
     if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+        await websocket.close(code=1008, reason="Invalid credentials")
+        return
     try:
-        docker_container = client.containers.get(container.container_id)
+        container = await resolve_owned_container(db, token_payload, container_id)
+        host = container_host(container)
+        if idle_tracker.is_suspended(container.container_id):
+            raise HTTPException(status_code=409, detail="Container suspended while idle")
+        docker_container = await host.events.get_container(container.container_id)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    except Exception as e:
+        print(f"Error watching filesystem of {container_id}: {e}")
+        await websocket.close(code=1011, reason="Container is not available")
+        return
+    if docker_container.status != 'running':
+        await websocket.close(code=1008, reason="Container is not running")
+        return
+    connection = await filesystem_watch.subscribe(websocket, container.container_id, container.user_id, host.engine, docker_container)
+    try:
+        while True:
+            # Nothing is expected from the client, but receiving notices the disconnect
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await filesystem_watch.unsubscribe(connection)
+
+# Listing limits for the folder content endpoint
+MAX_LISTING_DEPTH = 8
+MAX_LISTING_LIMIT = 5000
+
+def encode_listing_cursor(entry: FileEntry) -> str:
+    is_file, path = listing_key(entry)
+    return base64.urlsafe_b64encode(f"{int(is_file)}:{path}".encode('utf-8')).decode('ascii')
+
+def decode_listing_cursor(cursor: str) -> tuple[bool, str]:
+    try:
+        is_file, _, path = base64.urlsafe_b64decode(cursor).decode('utf-8').partition(':')
+        return bool(int(is_file)), path
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@docker_router.get("/docker/filesystem/{container_id}/{path}")
+async def get_container_folder_content(container_id: str, path: str, request: Request, response: Response, depth: int = Query(1, ge=1, le=MAX_LISTING_DEPTH), limit: int = Query(1000, ge=1, le=MAX_LISTING_LIMIT), cursor: Optional[str] = None, format: Literal["items", "compact"] = "items", container: OwnedContainer = Depends(get_active_container)):
+    """
+    List the entries under a base64 encoded folder path, down to depth levels.
+    Results are sorted directories first, then by path, and paginated with the
+    X-Next-Cursor response header. format=compact works as for the whole tree.
+    """
+    host = container_host(container)
+    try:
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to list all files and directories
-        exec_result_directories = docker_container.exec_run("find /app -type d -exec echo {} \\;", tty=True)
-        exec_result_files = docker_container.exec_run("find /app -type f -exec echo {} \\;", tty=True)
+        decoded_path = normalize_path(base64.b64decode(path).decode('utf-8'))
+        after = decode_listing_cursor(cursor) if cursor else None
 
-        if exec_result_directories.exit_code != 0 and exec_result_files.exit_code != 0:
-            raise HTTPException(status_code=500, detail="Error retrieving file system structure")
-        
-        directories_output = exec_result_directories.output.decode("utf-8").strip().split("\n")
-        files_output = exec_result_files.output.decode("utf-8").strip().split("\n")
+        # Serve from the cached tree, or list only the requested levels with find
+        accept_gzip = compact_accepts_gzip(request, format)
+        cached = filesystem_cache.list_directory(container.container_id, decoded_path, depth)
+        if cached is not None:
+            etag, entries = cached
+            etag = representation_etag(etag, format, accept_gzip)
+            if request.headers.get("if-none-match") == etag:
+                return not_modified(etag, format)
+            response.headers["ETag"] = etag
+        else:
+            entries = await host.engine.run(scan_directory, docker_container, decoded_path, depth, operation="filesystem")
 
-        decoded_path= base64.b64decode(path).decode('utf-8')
-        
-        files = []
-        for item in directories_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind='directory',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        for item in files_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind= 'file',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        
-        files = [file for file in files if file.parentPath and decoded_path in file.parentPath]
+        if entries is None:
+            raise HTTPException(status_code=404, detail="Folder not found")
 
-        return files
+        entries = sorted(entries, key=listing_key)
+        if after is not None:
+            entries = [entry for entry in entries if listing_key(entry) > after]
+        if len(entries) > limit:
+            entries = entries[:limit]
+            response.headers["X-Next-Cursor"] = encode_listing_cursor(entries[-1])
 
+        headers = {name: response.headers[name] for name in ("ETag", "X-Next-Cursor") if name in response.headers}
+        if format == "compact":
+            return await compact_tree_response(entries, decoded_path, accept_gzip, headers)
+        return await filesystem_items_response(entries, headers)
+
+    except HTTPException:
+        raise
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file system structure: {str(e)}")    
 
 @docker_router.get("/docker/file-content/{container_id}")
-def get_file_content(container_id: str, file_path: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def get_file_content(container_id: str, file_path: str, response: Response, container: OwnedContainer = Depends(get_active_container)):
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to read the file content
-        exec_result = docker_container.exec_run(f"cat {file_path}", tty=True)
-
-        if exec_result.exit_code != 0:
+        # Read the file content through the file agent or the archive API
+        try:
+            data, version = await host.engine.run(read_file_version, docker_container, file_path, operation="read")
+        except (docker.errors.NotFound, IsADirectoryError, FileAgentError):
             raise HTTPException(status_code=500, detail="Error retrieving file content")
         
-        file_content = exec_result.output.decode("utf-8").strip()
-        
-        return file_content
+        # The hash is the base for delta saves
+        response.headers["X-Content-Hash"] = file_content_cache.put(container.container_id, file_path, data, version)
+        return data.decode("utf-8", "replace")
 
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file content: {str(e)}")
     
+def range_not_satisfiable(size: int) -> HTTPException:
+    return HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+
+def parse_range_header(range_header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Parse a single "bytes=start-end" range into an inclusive (start, end) pair.
+    Returns None for headers that should be ignored (multiple or malformed ranges),
+    and raises 416 for ranges outside the file, including any range of an empty file.
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0 or size == 0:
+                raise range_not_satisfiable(size)
+            return max(size - suffix, 0), size - 1
+        first, last = int(start), int(end) if end else None
+    except ValueError:
+        return None
+    if last is not None and first > last:
+        return None
+    if first >= size:
+        raise range_not_satisfiable(size)
+    return first, size - 1 if last is None else min(last, size - 1)
+
+def guess_content_type(path: str) -> str:
+    content_type, _ = mimetypes.guess_type(path)
+    if content_type is None:
+        return "application/octet-stream"
+    if content_type.startswith("text/"):
+        return f"{content_type}; charset=utf-8"
+    return content_type
+
+@docker_router.get("/docker/file-stream/{container_id}")
+async def stream_file_content(container_id: str, file_path: str, request: Request, container: OwnedContainer = Depends(get_active_container)):
+    """
+    Stream the raw bytes of a file with Range and If-None-Match support.
+    """
+    host = container_host(container)
+    try:
+        docker_container = await host.events.get_container(container.container_id)
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail="Docker container not found")
+
+    if docker_container.status != 'running':
+        raise HTTPException(status_code=400, detail="Container is not running")
+
+    try:
+        stat, stream = await host.engine.run(open_file, docker_container, file_path, operation="read")
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving file content: {str(e)}")
+
+    if stat.is_dir:
+        stream.close()
+        raise HTTPException(status_code=400, detail="Path is a directory")
+
+    if request.headers.get("if-none-match") == stat.etag:
+        stream.close()
+        return Response(status_code=304, headers={"ETag": stat.etag})
+
+    headers = {"ETag": stat.etag, "Accept-Ranges": "bytes"}
+    byte_range = None
+    if request.headers.get("range"):
+        try:
+            byte_range = parse_range_header(request.headers["range"], stat.size)
+        except HTTPException:
+            stream.close()
+            raise
+
+    if byte_range is None:
+        # A file still being written can have grown since the stat, so stop at its size
+        headers["Content-Length"] = str(stat.size)
+        return StreamingResponse(host.engine.iterate(iter_file_content(stream, length=stat.size)), media_type=guess_content_type(file_path), headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.size}"
+    return StreamingResponse(host.engine.iterate(iter_file_content(stream, start, end - start + 1)), status_code=206, media_type=guess_content_type(file_path), headers=headers)
+
+def existing_file_modes(container_id: str, docker_container, paths: list[str]) -> dict[str, int]:
+    """
+    Look up the modes of files about to be overwritten, from the cache or one find exec.
+    """
+    entries = filesystem_cache.lookup(container_id, paths)
+    missing = [path for path in paths if path not in entries]
+    if missing:
+        entries.update(stat_paths(docker_container, missing))
+    return {path: entry.mode for path, entry in entries.items() if entry.kind == 'file'}
+
+def save_uploads(container_id: str, docker_container, uploads: list[FileUpload]):
+    """
+    Write uploads with a single put_archive and patch the filesystem cache.
+    """
+    # Whole seconds, so the written mtime is known exactly and a later change by
+    # anything else shows up as a different version of the cached content
+    now = int(time.time())
+    write_files(docker_container, uploads, now)
+    for upload in uploads:
+        filesystem_cache.upsert(container_id, FileEntry(upload.path, 'file', len(upload.data), now, upload.mode))
+        file_content_cache.put(container_id, upload.path, upload.data, (len(upload.data), float(now)))
+
+def load_base_content(container_id: str, docker_container, file_path: str, base_hash: str) -> bytes:
+    """
+    Return the current content of a file if it matches base_hash, otherwise raise a 409.
+    """
+    # The cached copy stands in for the file only while its size and mtime are unchanged
+    version = stat_file(docker_container, file_path)
+    if version is None:
+        raise HTTPException(status_code=409, detail={"message": "Base file not found", "hash": None})
+    cached = file_content_cache.get(container_id, file_path)
+    if cached is not None and cached[0] == base_hash and cached[2] == version:
+        return cached[1]
+    try:
+        data = read_file_content(docker_container, file_path)
+    except (docker.errors.NotFound, IsADirectoryError, FileAgentError):
+        raise HTTPException(status_code=409, detail={"message": "Base file not found", "hash": None})
+    digest = file_content_cache.put(container_id, file_path, data, version)
+    if digest != base_hash:
+        raise HTTPException(status_code=409, detail={"message": "Base content does not match", "hash": digest})
+    return data
+
+class TextEdit(BaseModel):
+    start: int
+    end: int
+    text: str
+
 class SaveContainerFile(BaseModel):
     container_id: str
     name: str
     parent_path: str
-    content: str
+    content: Optional[str] = None
+    # Delta mode: edits against the content whose sha256 is base_hash.
+    # Clients should send the full content instead when the edits are larger.
+    base_hash: Optional[str] = None
+    edits: Optional[list[TextEdit]] = None
+    result_hash: Optional[str] = None
     
 @docker_router.post("/docker/save-file-content")
-def save_file_content(req:SaveContainerFile, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def save_file_content(req:SaveContainerFile, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
+        file_path = normalize_path(posixpath.join('/', req.parent_path, req.name))
+
+        if req.edits is not None:
+            # Apply the edits to the cached or current file content
+            if req.base_hash is None:
+                raise HTTPException(status_code=400, detail="base_hash is required with edits")
+            base_content = await host.engine.run(load_base_content, container.container_id, docker_container, file_path, req.base_hash, operation="read")
+            try:
+                content = apply_text_edits(base_content.decode('utf-8'), [(edit.start, edit.end, edit.text) for edit in req.edits])
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid edits")
+        elif req.content is not None:
+            content = req.content
+        else:
+            raise HTTPException(status_code=400, detail="Either content or edits must be provided")
+
         # Normalize newlines to Unix-style
-        normalized_content = req.content.replace('\r\n', '\n')
-
-        # Create an in-memory tar archive containing the file
-        tar_stream = io.BytesIO()
-        with tarfile.open(fileobj=tar_stream, mode='w') as tar:
-            tarinfo = tarfile.TarInfo(name=req.name)
-            tarinfo.size = len(normalized_content.encode('utf-8'))
-            tar.addfile(tarinfo, io.BytesIO(normalized_content.encode('utf-8')))
-        tar_stream.seek(0)
-        
-        # Upload the tar archive to the Docker container
-        docker_container.put_archive(path=req.parent_path, data=tar_stream)
+        encoded_content = content.replace('\r\n', '\n').encode('utf-8')
+        if req.result_hash is not None and content_hash(encoded_content) != req.result_hash:
+            raise HTTPException(status_code=409, detail="Saved content does not match result_hash")
+
+        modes = await host.engine.run(existing_file_modes, container.container_id, docker_container, [file_path], operation="filesystem")
+        mode = modes.get(file_path, 0o644)
+
+        # Upload the file as a streamed tar archive, keeping the existing mode
+        await host.engine.run(save_uploads, container.container_id, docker_container, [FileUpload(file_path, encoded_content, mode)], operation="write")
         
-        return {"message": "File content saved successfully"}
+        return {"message": "File content saved successfully", "hash": content_hash(encoded_content)}
 
+    except HTTPException:
+        raise
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
     except Exception as e:
 
         raise HTTPException(status_code=500, detail=f"Error saving file content: {str(e)}")
+
+class SaveFileItem(BaseModel):
+    name: str
+    parent_path: str
+    content: str
+    mode: Optional[int] = None
+
+class SaveContainerFiles(BaseModel):
+    container_id: str
+    files: list[SaveFileItem]
+
+@docker_router.post("/docker/save-files-content")
+async def save_files_content(req: SaveContainerFiles, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    """
+    Save many files, possibly in different folders, with a single tar upload.
+    Existing file modes are kept unless a mode is given. Returns one result per file.
+    """
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
+    try:
+        docker_container = await host.events.get_container(container.container_id)
+        
+        if docker_container.status != 'running':
+            raise HTTPException(status_code=400, detail="Container is not running")
+
+        results = []
+        paths = {}
+        for file in req.files:
+            file_path = normalize_path(posixpath.join(file.parent_path, file.name))
+            if not file.parent_path.startswith('/') or not file.name or '/' in file.name or file.name in ('.', '..'):
+                results.append({"path": file_path, "saved": False, "error": "Invalid file path"})
+            elif file_path in paths:
+                results.append({"path": file_path, "saved": False, "error": "Duplicate file path"})
+            else:
+                paths[file_path] = file
+                results.append({"path": file_path, "saved": True, "error": None})
+
+        modes = await host.engine.run(existing_file_modes, container.container_id, docker_container, [path for path, file in paths.items() if file.mode is None], operation="filesystem") if paths else {}
+        uploads = [
+            FileUpload(path, file.content.replace('\r\n', '\n').encode('utf-8'), file.mode if file.mode is not None else modes.get(path, 0o644))
+            for path, file in paths.items()
+        ]
+
+        if uploads:
+            try:
+                await host.engine.run(save_uploads, container.container_id, docker_container, uploads, operation="write")
+            except Exception as e:
+                for result in results:
+                    if result["saved"]:
+                        result.update(saved=False, error=str(e))
+
+        return {"files": results}
+
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail="Docker container not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error saving file content: {str(e)}")
     
 class MoveContainerItem(BaseModel):
     container_id: str
@@ -491,32 +1130,23 @@ class MoveContainerItem(BaseModel):
     destination_path: str
 
 @docker_router.post("/docker/move-item")
-def move_item(req: MoveContainerItem, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def move_item(req: MoveContainerItem, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to move the file or folder
-        exec_result = docker_container.exec_run(f"mv {req.source_path} {req.destination_path}", tty=True)
-
-        if exec_result.exit_code != 0:
+        # Move the file or folder through the file agent
+        if not await host.engine.run(run_file_operation, docker_container, "move", source=req.source_path, destination=req.destination_path, operation="exec"):
             raise HTTPException(status_code=500, detail="Error moving item")
+        filesystem_cache.move(container.container_id, req.source_path, req.destination_path)
+        file_content_cache.remove(container.container_id, req.source_path)
+        file_content_cache.remove(container.container_id, req.destination_path)
         
         return {"message": "Item moved successfully"}
 
@@ -530,33 +1160,21 @@ class CreateFolderRequest(BaseModel):
     folder_path: str
 
 @docker_router.post("/docker/create-folder")
-def create_folder(req: CreateFolderRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def create_folder(req: CreateFolderRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to create the folder
-        
-        exec_result = docker_container.exec_run(f"mkdir -p {req.folder_path}", tty=True)
-
-        if exec_result.exit_code != 0:
+        # Create the folder through the file agent
+        if not await host.engine.run(run_file_operation, docker_container, "mkdir", path=req.folder_path, operation="exec"):
             raise HTTPException(status_code=500, detail="Error creating folder")
+        filesystem_cache.upsert(container.container_id, FileEntry(req.folder_path, 'directory', 0, time.time()))
         
         return {"message": "Folder created successfully"}
 
@@ -570,32 +1188,21 @@ class CreateFileRequest(BaseModel):
     file_path: str
 
 @docker_router.post("/docker/create-file")
-def create_file(req: CreateFileRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def create_file(req: CreateFileRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to create the file
-        exec_result = docker_container.exec_run(f"touch {req.file_path}", tty=True)
-
-        if exec_result.exit_code != 0:
+        # Create the file through the file agent
+        if not await host.engine.run(run_file_operation, docker_container, "touch", path=req.file_path, operation="exec"):
             raise HTTPException(status_code=500, detail="Error creating file")
+        filesystem_cache.touch(container.container_id, req.file_path)
         
         return {"message": "File created successfully"}
 
@@ -609,32 +1216,22 @@ class RemovePathRequest(BaseModel):
     path: str
 
 @docker_router.post("/docker/remove-path")
-def remove_path(req: RemovePathRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
-    if not container:
-        raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
-    
+async def remove_path(req: RemovePathRequest, token_payload: dict = Depends(get_token_payload), db: AsyncSession = Depends(get_async_db)):
+    container = await resolve_owned_container(db, token_payload, req.container_id)
+    await resume_container(container.container_id)
+
+    host = container_host(container)
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = await host.events.get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to remove the file or folder
-        exec_result = docker_container.exec_run(f"rm -rf {req.path}", tty=True)
-
-        if exec_result.exit_code != 0:
+        # Remove the file or folder through the file agent
+        if not await host.engine.run(run_file_operation, docker_container, "remove", path=req.path, operation="exec"):
             raise HTTPException(status_code=500, detail="Error removing path")
+        filesystem_cache.remove(container.container_id, req.path)
+        file_content_cache.remove(container.container_id, req.path)
         
         return {"message": "Path removed successfully"}
 
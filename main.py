@@ -1,9 +1,35 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from controllers.auth import auth_router
 from controllers.docker import docker_router 
+from repositories.database_repository import AsyncSessionLocal
+from repositories.docker_hosts import docker_hosts
+from repositories.filesystem_watch import filesystem_watch
+from repositories.idle_tracker import IDLE_TRACKER_ENABLED, idle_tracker
+from repositories.jobs import jobs
+from repositories.scheduler import scheduler
+from repositories.terminal import terminal_sessions
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Check the Docker hosts, then sync their container statuses, images and warm pools
+    await docker_hosts.start()
+    # Admit queued containers as host capacity frees up
+    scheduler.start()
+    # Suspend workspaces left idle
+    if IDLE_TRACKER_ENABLED:
+        async with AsyncSessionLocal() as db:
+            await idle_tracker.start(db)
+    yield
+    terminal_sessions.close_all()
+    await filesystem_watch.stop()
+    await jobs.stop()
+    await idle_tracker.stop()
+    await docker_hosts.stop()
+    await scheduler.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 origins = [
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import BigInteger, Column, Float, Integer, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from models.base import Base
@@ -8,7 +8,10 @@ from sqlalchemy import Enum as SqlEnum
 class ContainerStatus(enum.Enum):
     exited = "exited"
     running = "running"
+    paused = "paused"
     created = "created"
+    # Waiting for host capacity before it can be used
+    queued = "queued"
 
 class Container(Base):
     __tablename__ = "containers"
@@ -17,7 +20,20 @@ class Container(Base):
     container_id = Column(String, unique=True, index=True)  # Docker container ID
     container_name = Column(String)
     user_id = Column(Integer, ForeignKey("users.id"))
+    # Name of the Docker host the container was placed on
+    docker_host = Column(String, nullable=True, index=True)
     status = Column(SqlEnum(ContainerStatus), default=ContainerStatus.created, nullable=False)
+    # Resource limits applied to the Docker container: CPU cores and memory in bytes
+    cpu_limit = Column(Float, nullable=True)
+    memory_limit = Column(BigInteger, nullable=True)
 
     # Define the relationship back to User
     owner = relationship("User", back_populates="containers")
+
+    # Ownership checks filter by user and container together, listings page by
+    # user (and optionally status) in id order
+    __table_args__ = (
+        Index("ix_containers_user_id_container_id", "user_id", "container_id"),
+        Index("ix_containers_user_id_id", "user_id", "id"),
+        Index("ix_containers_user_id_status_id", "user_id", "status", "id"),
+    )
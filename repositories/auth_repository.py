@@ -1,6 +1,9 @@
 import jwt
 from datetime import datetime, timedelta
+import threading
 import time
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional
 
 # Secret key for JWT signing and encoding
 SECRET_KEY = "your_jwt_secret_key"
@@ -34,4 +37,57 @@ def verify_token(token: str)-> dict[str,str]:
     except jwt.ExpiredSignatureError:
         return None  # Token expired
     except jwt.InvalidTokenError:
-        return None  # Invalid token
\ No newline at end of file
+        return None  # Invalid token
+
+# Authenticated users cached by token subject
+USER_CACHE_MAX_ENTRIES = 10000
+USER_CACHE_TTL_SECONDS = 60
+
+# Positive container ownership checks cached by (token subject, container_id)
+OWNERSHIP_CACHE_MAX_ENTRIES = 10000
+OWNERSHIP_CACHE_TTL_SECONDS = 5
+
+class CachedUser(NamedTuple):
+    id: int
+    username: str
+    email: str
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after the TTL and never outlive the
+    exp claim of the token that loaded them.
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            value, expires_at = cached
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, token_exp: Optional[float] = None):
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+user_cache = TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+ownership_cache = TTLCache(OWNERSHIP_CACHE_MAX_ENTRIES, OWNERSHIP_CACHE_TTL_SECONDS)
@@ -0,0 +1,184 @@
+import asyncio
+import os
+from typing import Optional, Union
+
+# Messages waiting to be sent on each websocket
+WEBSOCKET_SEND_QUEUE_SIZE = 32
+# What happens to a client whose queue is full when a message is broadcast:
+# "drop" skips the message, "disconnect" closes the websocket so the client reconnects
+WEBSOCKET_SLOW_CONSUMER_POLICY = os.environ.get("WEBSOCKET_SLOW_CONSUMER_POLICY", "disconnect")
+# Close code sent to slow consumers: try again later
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+Message = Union[str, bytes]
+
+class Connection:
+    """
+    A Starlette websocket with its own send queue, written by a single task so
+    messages to one client never wait on another.
+    """
+    def __init__(self, websocket, container_id: Optional[str], user_id: Optional[int], queue_size: int = WEBSOCKET_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.container_id = container_id
+        self.user_id = user_id
+        self.dropped = 0
+        self.closed = False
+        # None asks the writer to close the websocket after the messages before it
+        self._queue: asyncio.Queue[Optional[Message]] = asyncio.Queue(queue_size)
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.get_running_loop().create_task(self._write())
+
+    async def send(self, message: Message):
+        """
+        Queue a message, waiting while the queue is full.
+        """
+        if not self.closed:
+            await self._queue.put(message)
+
+    def offer(self, message: Message) -> bool:
+        """
+        Queue a message unless the queue is full.
+        """
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def end(self):
+        """
+        Close the websocket once the queued messages are sent.
+        """
+        await self.send(None)
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self._queue.get()
+                if message is None:
+                    await self.websocket.close()
+                    return
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+        except Exception as e:
+            # The client went away; the receiving side disconnects it
+            print(f"Error sending to websocket: {e}")
+        finally:
+            self.closed = True
+            # Release senders waiting for room in the queue
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    def stop(self):
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+
+    async def abort(self, code: int, reason: Optional[str] = None):
+        """
+        Drop the queued messages and close the websocket with the given code.
+        """
+        self.stop()
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+class ConnectionManager:
+    """
+    Open websockets indexed by container and user. Broadcasts only queue messages, so
+    a slow client gets the slow consumer policy instead of holding up the others.
+    """
+    def __init__(self, queue_size: int = WEBSOCKET_SEND_QUEUE_SIZE, slow_consumer_policy: str = WEBSOCKET_SLOW_CONSUMER_POLICY):
+        if slow_consumer_policy not in ("drop", "disconnect"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: set[Connection] = set()
+        self._by_container: dict[str, set[Connection]] = {}
+        self._by_user: dict[int, set[Connection]] = {}
+        self.dropped_messages = 0
+        self.slow_consumers_disconnected = 0
+
+    async def connect(self, websocket, container_id: Optional[str] = None, user_id: Optional[int] = None) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, container_id, user_id, self.queue_size)
+        self.active_connections.add(connection)
+        if container_id is not None:
+            self._by_container.setdefault(container_id, set()).add(connection)
+        if user_id is not None:
+            self._by_user.setdefault(user_id, set()).add(connection)
+        connection.start()
+        return connection
+
+    def disconnect(self, connection: Connection):
+        if connection not in self.active_connections:
+            return
+        self.active_connections.discard(connection)
+        self._unindex(self._by_container, connection.container_id, connection)
+        self._unindex(self._by_user, connection.user_id, connection)
+        connection.stop()
+
+    def _unindex(self, index: dict, key, connection: Connection):
+        connections = index.get(key)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del index[key]
+
+    def select(self, container_id: Optional[str] = None, user_id: Optional[int] = None) -> list[Connection]:
+        """
+        The connections of a container, of a user, or all of them.
+        """
+        if container_id is not None:
+            return list(self._by_container.get(container_id, ()))
+        if user_id is not None:
+            return list(self._by_user.get(user_id, ()))
+        return list(self.active_connections)
+
+    def broadcast(self, message: Message, container_id: Optional[str] = None, user_id: Optional[int] = None) -> int:
+        """
+        Queue a message for the connections of a container, of a user, or for all of
+        them. Returns the number of connections it was queued for.
+        """
+        queued = 0
+        for connection in self.select(container_id, user_id):
+            if connection.offer(message):
+                queued += 1
+            else:
+                self._slow_consumer(connection)
+        return queued
+
+    def _slow_consumer(self, connection: Connection):
+        if self.slow_consumer_policy == "drop":
+            connection.dropped += 1
+            self.dropped_messages += 1
+            return
+        self.slow_consumers_disconnected += 1
+        self.disconnect(connection)
+        asyncio.get_running_loop().create_task(connection.abort(SLOW_CONSUMER_CLOSE_CODE))
+
+    def count(self, container_id: Optional[str] = None, user_id: Optional[int] = None) -> int:
+        if container_id is not None:
+            return len(self._by_container.get(container_id, ()))
+        if user_id is not None:
+            return len(self._by_user.get(user_id, ()))
+        return len(self.active_connections)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.active_connections),
+            "containers": len(self._by_container),
+            "users": len(self._by_user),
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "dropped_messages": self.dropped_messages,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected,
+        }
+
+connections = ConnectionManager()
@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from typing import Optional
+from sqlalchemy import bindparam, select, update
+from models.container import Container, ContainerStatus
+from repositories.database_repository import AsyncSessionLocal
+from repositories.docker_repository import DockerEngine
+
+# Follow the Docker events stream to keep container statuses in sync
+DOCKER_EVENTS_ENABLED = True
+# Seconds between database flushes of buffered status changes
+DOCKER_EVENTS_FLUSH_SECONDS = 1
+# Seconds to wait before reconnecting, doubled after each failure up to the maximum
+DOCKER_EVENTS_RECONNECT_SECONDS = 1
+DOCKER_EVENTS_RECONNECT_MAX_SECONDS = 30
+
+# Docker status after each container event; destroy is handled separately
+EVENT_STATUSES = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+# Database status for each Docker container state
+DOCKER_STATUSES = {
+    "created": ContainerStatus.created,
+    "running": ContainerStatus.running,
+    "restarting": ContainerStatus.running,
+    "paused": ContainerStatus.paused,
+    "exited": ContainerStatus.exited,
+    "removing": ContainerStatus.exited,
+    "dead": ContainerStatus.exited,
+}
+
+def container_status(docker_status: str) -> ContainerStatus:
+    return DOCKER_STATUSES.get(docker_status, ContainerStatus.exited)
+
+class ContainerStatusMap:
+    """
+    Last known Docker status of each container, keyed by container_id.
+    """
+    def __init__(self):
+        self._statuses: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, container_id: str) -> Optional[str]:
+        with self._lock:
+            return self._statuses.get(container_id)
+
+    def set(self, container_id: str, status: str):
+        with self._lock:
+            self._statuses[container_id] = status
+
+    def remove(self, container_id: str):
+        with self._lock:
+            self._statuses.pop(container_id, None)
+
+    def replace(self, statuses: dict[str, str]):
+        with self._lock:
+            self._statuses = dict(statuses)
+
+class ContainerEventReconciler:
+    """
+    Follows the Docker events stream of one daemon on a background thread. Status
+    changes update the in-memory map at once and are written to the containers table
+    in batches. Every (re)connection starts with a full reconcile against the daemon.
+    """
+    def __init__(self, docker_engine: DockerEngine, host_name: str):
+        self.engine = docker_engine
+        self.host_name = host_name
+        self.statuses = ContainerStatusMap()
+        # True while the map is known to be complete and up to date
+        self.synced = False
+        self._pending: dict[str, ContainerStatus] = {}
+        self._snapshot: Optional[dict[str, ContainerStatus]] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._events = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._stopped.clear()
+        threading.Thread(target=self._watch, name=f"docker-events-{self.host_name}", daemon=True).start()
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        self._stopped.set()
+        events = self._events
+        if events is not None:
+            events.close()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def _watch(self):
+        delay = DOCKER_EVENTS_RECONNECT_SECONDS
+        while not self._stopped.is_set():
+            try:
+                # Subscribe before listing so no change falls between the two
+                self._events = self.engine.client.events(decode=True, filters={"type": "container"})
+                self._reconcile()
+                self.synced = True
+                delay = DOCKER_EVENTS_RECONNECT_SECONDS
+                for event in self._events:
+                    self._apply(event)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    print(f"Docker events stream of {self.host_name} failed: {e}")
+            finally:
+                self.synced = False
+                self._events = None
+            self._stopped.wait(delay)
+            delay = min(delay * 2, DOCKER_EVENTS_RECONNECT_MAX_SECONDS)
+
+    def _reconcile(self):
+        statuses = {container.id: container.status for container in self.engine.client.containers.list(all=True, sparse=True)}
+        self.statuses.replace(statuses)
+        with self._lock:
+            self._snapshot = {container_id: container_status(status) for container_id, status in statuses.items()}
+            self._pending.clear()
+
+    def _apply(self, event: dict):
+        container_id = event.get("Actor", {}).get("ID") or event.get("id")
+        action = event.get("Action")
+        if not container_id:
+            return
+        if action == "destroy":
+            self.statuses.remove(container_id)
+            status = ContainerStatus.exited
+        elif action in EVENT_STATUSES:
+            self.statuses.set(container_id, EVENT_STATUSES[action])
+            status = container_status(EVENT_STATUSES[action])
+        else:
+            return
+        with self._lock:
+            self._pending[container_id] = status
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(DOCKER_EVENTS_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error saving container statuses: {e}")
+
+    async def flush(self):
+        """
+        Write buffered status changes to the database in one transaction.
+        """
+        with self._lock:
+            snapshot, self._snapshot = self._snapshot, None
+            pending, self._pending = self._pending, {}
+        if snapshot is None and not pending:
+            return
+        async with AsyncSessionLocal() as db:
+            changes = {}
+            if snapshot is not None:
+                # Containers the daemon no longer knows about are reported as exited,
+                # queued containers keep their status until the scheduler admits them
+                rows = await db.execute(select(Container.container_id, Container.status).where(Container.docker_host == self.host_name))
+                for container_id, status in rows:
+                    if status == ContainerStatus.queued:
+                        continue
+                    expected = snapshot.get(container_id, ContainerStatus.exited)
+                    if status != expected:
+                        changes[container_id] = expected
+            changes.update(pending)
+            if changes:
+                table = Container.__table__
+                await db.execute(
+                    update(table).where(table.c.container_id == bindparam("b_container_id"), table.c.status != ContainerStatus.queued).values(status=bindparam("b_status")),
+                    [{"b_container_id": container_id, "b_status": status} for container_id, status in changes.items()],
+                )
+                await db.commit()
+
+    async def get_container(self, container_id: str):
+        """
+        Return a container model, using the known status instead of inspecting the
+        container when the map is in sync. The model only carries the id and status.
+        """
+        status = self.statuses.get(container_id) if self.synced else None
+        if status is None:
+            return await self.engine.get_container(container_id)
+        return self.engine.client.containers.prepare_model({"Id": container_id, "State": {"Status": status}})
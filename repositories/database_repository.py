@@ -1,22 +1,73 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event, func, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
-from models.container import Container
+from sqlalchemy.orm.attributes import get_history
+from typing import Optional
+from models.container import Container, ContainerStatus
 from models.user import User
 from models.base import Base  # Import the shared Base
+from repositories.auth_repository import user_cache
 import hashlib
 
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./test.db")
+SQLALCHEMY_ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# "production" enables WAL and a sized pool, "default" keeps the plain SQLite settings
+DATABASE_MODE = os.environ.get("DATABASE_MODE", "production")
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "10"))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", "20"))
+DATABASE_BUSY_TIMEOUT_MS = int(os.environ.get("DATABASE_BUSY_TIMEOUT_MS", "5000"))
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DATABASE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def engine_options(url: str) -> dict:
+    if DATABASE_MODE != "production":
+        return {"connect_args": {"check_same_thread": False}} if url.startswith("sqlite") else {}
+    options = {"pool_size": DATABASE_POOL_SIZE, "max_overflow": DATABASE_MAX_OVERFLOW, "pool_pre_ping": True}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False, "timeout": DATABASE_BUSY_TIMEOUT_MS / 1000}
+    return options
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, **engine_options(SQLALCHEMY_ASYNC_DATABASE_URL))
+if DATABASE_MODE == "production" and SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 # Create database tables
 # User.metadata.create_all(bind=engine)
 # Container.metadata.create_all(bind=engine)
 Base.metadata.create_all(bind=engine)
+# create_all skips existing tables, so add columns declared after they were created
+_container_columns = {column["name"] for column in inspect(engine).get_columns(Container.__tablename__)}
+with engine.begin() as connection:
+    for column in Container.__table__.columns:
+        if column.name not in _container_columns:
+            connection.execute(text(f"ALTER TABLE {Container.__tablename__} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+# create_all skips existing tables, so add indexes declared after they were created
+for index in Container.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+
+# Drop cached users whenever a user row changes
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, target: User):
+    user_cache.invalidate(target.email)
+    # Also drop the entry of a previous email when it changed
+    for email in get_history(target, "email").deleted or ():
+        user_cache.invalidate(email)
 
 # Dependency to get DB session
 def get_db():
@@ -26,6 +77,11 @@ def get_db():
     finally:
         db.close()
 
+# Dependency to get an async DB session for async routes
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # Utility to hash passwords
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -53,3 +109,35 @@ def get_user_by_email_or_username(db: Session, email: str, username: str):
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
+
+# Function to get the Docker host a container was placed on
+async def get_container_docker_host(db: AsyncSession, container_id: str) -> Optional[str]:
+    result = await db.execute(select(Container.docker_host).where(Container.container_id == container_id))
+    return result.scalar_one_or_none()
+
+# Function to get the containers among container_ids owned by the user with the given email
+async def list_containers_by_owner_email(db: AsyncSession, email: str, container_ids: list[str]):
+    result = await db.execute(select(Container.id, Container.container_id, Container.user_id, User.email, Container.docker_host).join(User, Container.user_id == User.id).where(User.email == email, Container.container_id.in_(container_ids)))
+    return result.all()
+
+# Columns returned by container listings
+CONTAINER_LISTING_COLUMNS = (Container.id, Container.container_id, Container.container_name, Container.user_id, Container.status, Container.cpu_limit, Container.memory_limit, Container.docker_host)
+
+def _user_containers_filter(user_id: int, status: Optional[ContainerStatus]):
+    conditions = [Container.user_id == user_id]
+    if status is not None:
+        conditions.append(Container.status == status)
+    return conditions
+
+# Function to get one page of a user's containers in id order, after the given id
+async def list_user_containers_page(db: AsyncSession, user_id: int, limit: int, after: Optional[int] = None, status: Optional[ContainerStatus] = None):
+    query = select(*CONTAINER_LISTING_COLUMNS).where(*_user_containers_filter(user_id, status))
+    if after is not None:
+        query = query.where(Container.id > after)
+    result = await db.execute(query.order_by(Container.id).limit(limit))
+    return result.all()
+
+# Function to count a user's containers, optionally with a given status
+async def count_user_containers(db: AsyncSession, user_id: int, status: Optional[ContainerStatus] = None) -> int:
+    result = await db.execute(select(func.count()).select_from(Container).where(*_user_containers_filter(user_id, status)))
+    return result.scalar_one()
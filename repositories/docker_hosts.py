@@ -0,0 +1,122 @@
+import asyncio
+import os
+from typing import Optional
+from sqlalchemy import update
+from models.container import Container
+from repositories.container_events import DOCKER_EVENTS_ENABLED, ContainerEventReconciler
+from repositories.database_repository import AsyncSessionLocal
+from repositories.docker_repository import DockerEngine
+from repositories.image_repository import ImageManager
+from repositories.scheduler import ResourceScheduler, host_capacity, scheduler
+from repositories.warm_pool import WarmPool
+
+# Docker daemons to place containers on, as comma-separated "name=url" or "url" items.
+# When empty, a single host named "default" is configured from the environment.
+DOCKER_HOSTS = os.environ.get("DOCKER_HOSTS", "")
+DEFAULT_DOCKER_HOST = "default"
+
+# Seconds between health checks, and failed checks before a host leaves placement
+DOCKER_HEALTH_CHECK_SECONDS = 10
+DOCKER_HEALTH_CHECK_FAILURES = 2
+
+class DockerHostUnavailableError(Exception):
+    pass
+
+def parse_docker_hosts(value: str) -> list[tuple[str, Optional[str]]]:
+    hosts = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, separator, url = item.partition("=")
+        hosts.append((name, url) if separator else (item, item))
+    return hosts or [(DEFAULT_DOCKER_HOST, None)]
+
+class DockerHost:
+    """
+    One Docker daemon with its own engine, event reconciler, images and warm pool.
+    """
+    def __init__(self, name: str, base_url: Optional[str] = None):
+        self.name = name
+        self.engine = DockerEngine(base_url)
+        self.events = ContainerEventReconciler(self.engine, name)
+        self.images = ImageManager(self.engine)
+        self.warm_pool = WarmPool(self.engine, self.images, self.events, name)
+        self.healthy = True
+        self.failures = 0
+
+class DockerHostPool:
+    """
+    The configured Docker hosts. Containers are routed to the host recorded on their
+    row; hosts failing their health checks are left out of placement until they recover.
+    """
+    def __init__(self, hosts: list[tuple[str, Optional[str]]], resources: ResourceScheduler):
+        self.hosts: dict[str, DockerHost] = {name: DockerHost(name, url) for name, url in hosts}
+        self.default = next(iter(self.hosts))
+        self.resources = resources
+        self._health_task: Optional[asyncio.Task] = None
+
+    def get(self, name: Optional[str]) -> DockerHost:
+        """
+        Return the host of a container. Rows without a host belong to the default one.
+        """
+        host = self.hosts.get(name or self.default)
+        if host is None:
+            raise DockerHostUnavailableError(f"Unknown Docker host: {name}")
+        return host
+
+    def placeable(self) -> list[str]:
+        return [name for name, host in self.hosts.items() if host.healthy]
+
+    async def check(self, host: DockerHost):
+        try:
+            # Connecting runs on the executor too, so a hung daemon only fails its own check
+            info = await host.engine.run(lambda: host.engine.client.info(), operation="inspect")
+            self.resources.set_capacity(host.name, host_capacity(info))
+            if not host.healthy:
+                print(f"Docker host {host.name} is back")
+            host.healthy = True
+            host.failures = 0
+        except Exception as e:
+            host.failures += 1
+            if host.healthy and host.failures >= DOCKER_HEALTH_CHECK_FAILURES:
+                print(f"Docker host {host.name} is unavailable: {e}")
+                host.healthy = False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(DOCKER_HEALTH_CHECK_SECONDS)
+            await asyncio.gather(*(self.check(host) for host in self.hosts.values()))
+
+    async def start(self):
+        # Containers created before hosts were recorded live on the default host
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(Container).where(Container.docker_host.is_(None)).values(docker_host=self.default))
+            await db.commit()
+        await asyncio.gather(*(self.check(host) for host in self.hosts.values()))
+        for host in self.hosts.values():
+            # Hosts unreachable at startup wait for a successful check
+            host.healthy = not host.failures
+            if DOCKER_EVENTS_ENABLED:
+                host.events.start()
+            # Pull the container image ahead of the first create request
+            host.images.start()
+            # Keep pre-created containers ready for new workspaces
+            async with AsyncSessionLocal() as db:
+                await host.warm_pool.start(db)
+        self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+        for host in self.hosts.values():
+            await host.warm_pool.stop()
+            await host.images.stop()
+            if DOCKER_EVENTS_ENABLED:
+                await host.events.stop()
+
+docker_hosts = DockerHostPool(parse_docker_hosts(DOCKER_HOSTS), scheduler)
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, Optional
+import docker
+
+# Connection pool and worker threads reserved for Docker calls, separate from the
+# Starlette threadpool so slow daemon calls cannot starve auth or websocket traffic
+DOCKER_MAX_POOL_SIZE = 32
+DOCKER_MAX_WORKERS = 32
+DOCKER_CLIENT_TIMEOUT_SECONDS = 120
+
+# Per-operation timeouts in seconds
+DOCKER_OPERATION_TIMEOUTS = {
+    "default": 60,
+    "connect": 10,
+    "inspect": 10,
+    "pull": 900,
+    "create": 60,
+    "start": 60,
+    "stop": 60,
+    "remove": 60,
+    "exec": 60,
+    "filesystem": 120,
+    "read": 120,
+    "write": 120,
+}
+
+class DockerTimeoutError(Exception):
+    pass
+
+class DockerEngine:
+    """
+    Async access to one Docker daemon. Blocking docker-py calls run on a bounded
+    executor of their own and are cancelled after a per-operation timeout.
+    """
+    def __init__(self, base_url: Optional[str] = None, max_pool_size: int = DOCKER_MAX_POOL_SIZE, max_workers: int = DOCKER_MAX_WORKERS, timeout: int = DOCKER_CLIENT_TIMEOUT_SECONDS):
+        self.base_url = base_url
+        self._client_options = {"max_pool_size": max_pool_size, "timeout": timeout}
+        self._client: Optional[docker.DockerClient] = None
+        self._client_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="docker")
+
+    @property
+    def client(self) -> docker.DockerClient:
+        """
+        The docker-py client, connecting on first use so an unreachable daemon does not
+        fail startup. Connecting asks the daemon for its API version and blocks, so code
+        on the event loop uses get_client() instead.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    if self.base_url:
+                        self._client = docker.DockerClient(base_url=self.base_url, **self._client_options)
+                    else:
+                        self._client = docker.from_env(**self._client_options)
+        return self._client
+
+    async def run(self, func, *args, operation: str = "default", **kwargs):
+        """
+        Run a blocking call on the Docker executor. Raises DockerTimeoutError when
+        the operation takes longer than its timeout.
+        """
+        timeout = DOCKER_OPERATION_TIMEOUTS.get(operation, DOCKER_OPERATION_TIMEOUTS["default"])
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs)), timeout)
+        except asyncio.TimeoutError:
+            raise DockerTimeoutError(f"Docker {operation} timed out after {timeout}s")
+
+    async def get_client(self) -> docker.DockerClient:
+        """
+        Return the client, connecting on the Docker executor if needed.
+        """
+        if self._client is not None:
+            return self._client
+        return await self.run(lambda: self.client, operation="connect")
+
+    async def get_container(self, container_id: str):
+        client = await self.get_client()
+        return await self.run(client.containers.get, container_id, operation="inspect")
+
+    async def iterate(self, iterator: Iterator[bytes], operation: str = "read") -> AsyncIterator[bytes]:
+        """
+        Consume a blocking iterator chunk by chunk on the Docker executor.
+        """
+        try:
+            while True:
+                chunk = await self.run(next, iterator, None, operation=operation)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            close = getattr(iterator, "close", None)
+            try:
+                if close is not None:
+                    close()
+            except ValueError:
+                # Still running on the executor after a cancellation
+                pass
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._client is not None:
+            self._client.close()
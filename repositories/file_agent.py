@@ -0,0 +1,312 @@
+import base64
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Optional
+from repositories.filesystem_repository import FileUpload, read_file, stat_paths, write_files
+
+# Run file operations through a long-lived helper process instead of one exec each
+FILE_AGENT_ENABLED = os.environ.get("FILE_AGENT_ENABLED", "true").lower() == "true"
+FILE_AGENT_PATH = "/tmp/.cenozoic-file-agent.py"
+FILE_AGENT_TIMEOUT_SECONDS = 30
+# Seconds before starting an agent again after a failed start
+FILE_AGENT_RETRY_SECONDS = 30
+
+# Helper run inside the container with python3. Requests and responses are JSON
+# frames prefixed with a 4-byte big-endian length. Arguments never go through a shell.
+FILE_AGENT_SOURCE = b'''
+import base64, json, os, shutil, struct, sys
+
+def mkdir(path):
+    os.makedirs(path, exist_ok=True)
+
+def touch(path):
+    with open(path, "a"):
+        os.utime(path)
+
+def move(source, destination):
+    shutil.move(source, destination)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def read(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+def stat(path):
+    result = os.stat(path)
+    return [result.st_size, result.st_mtime]
+
+OPERATIONS = {"mkdir": mkdir, "touch": touch, "move": move, "remove": remove, "read": read, "stat": stat}
+
+def read_exact(size):
+    data = b""
+    while len(data) < size:
+        chunk = sys.stdin.buffer.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+while True:
+    header = read_exact(4)
+    if header is None:
+        break
+    request = json.loads(read_exact(struct.unpack(">I", header)[0]))
+    try:
+        response = {"id": request["id"], "ok": True, "result": OPERATIONS[request["op"]](**request.get("args", {}))}
+    except Exception as e:
+        response = {"id": request["id"], "ok": False, "error": str(e)}
+    body = json.dumps(response).encode()
+    sys.stdout.buffer.write(struct.pack(">I", len(body)) + body)
+    sys.stdout.buffer.flush()
+'''
+
+class FileAgentError(Exception):
+    pass
+
+def raw_socket(sock):
+    """
+    Return the underlying socket of a docker-py attach socket.
+    """
+    return getattr(sock, '_sock', sock)
+
+class FileAgent:
+    """
+    Client for the helper process of one container. Requests are pipelined over the
+    attached exec socket and matched to responses by id.
+    """
+    def __init__(self, docker_container):
+        self.container_id = docker_container.id
+        write_files(docker_container, [FileUpload(FILE_AGENT_PATH, FILE_AGENT_SOURCE, 0o755)])
+        api = docker_container.client.api
+        exec_id = api.exec_create(docker_container.id, ["python3", "-u", FILE_AGENT_PATH], stdin=True, stdout=True, stderr=False, tty=False)['Id']
+        self._sock = raw_socket(api.exec_start(exec_id, socket=True))
+        self._ids = itertools.count(1)
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self.alive = True
+        self.answered = False
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def _recv_exact(self, size: int) -> Optional[bytes]:
+        data = b""
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_stdout(self):
+        # Demultiplex the docker stream: 8-byte header with stream type and frame size
+        while True:
+            header = self._recv_exact(8)
+            if header is None:
+                return
+            payload = self._recv_exact(struct.unpack(">BxxxL", header)[1])
+            if payload is None:
+                return
+            if header[0] == 1:
+                yield payload
+
+    def _read_responses(self):
+        pending = b""
+        try:
+            for payload in self._read_stdout():
+                pending += payload
+                while len(pending) >= 4:
+                    size = struct.unpack(">I", pending[:4])[0]
+                    if len(pending) < 4 + size:
+                        break
+                    response = json.loads(pending[4:4 + size])
+                    pending = pending[4 + size:]
+                    self.answered = True
+                    with self._lock:
+                        future = self._pending.pop(response["id"], None)
+                    if future is not None:
+                        future.set_result(response)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def request(self, op: str, **args):
+        """
+        Send one operation and wait for its result. Raises FileAgentError on failure.
+        """
+        future = Future()
+        with self._lock:
+            if not self.alive:
+                raise FileAgentError("File agent is not running")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            body = json.dumps({"id": request_id, "op": op, "args": args}).encode()
+            try:
+                self._sock.sendall(struct.pack(">I", len(body)) + body)
+            except OSError as e:
+                self._pending.pop(request_id, None)
+                raise FileAgentError(str(e))
+        try:
+            response = future.result(timeout=FILE_AGENT_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise FileAgentError(f"File agent timed out on {op}")
+        if not response["ok"]:
+            raise FileAgentError(response["error"])
+        return response.get("result")
+
+    def close(self):
+        with self._lock:
+            self.alive = False
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_result({"ok": False, "error": "File agent stopped"})
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+_agents: dict[str, FileAgent] = {}
+_unsupported: set[str] = set()
+# Agents being started, so concurrent callers wait for the same start
+_starting: dict[str, Future] = {}
+# When starting the agent of a container last failed
+_failed_at: dict[str, float] = {}
+# Guards the dicts above only; agents are started without holding it
+_agents_lock = threading.Lock()
+
+def get_file_agent(docker_container) -> Optional[FileAgent]:
+    """
+    Return the running agent of a container, starting it on first use.
+    Returns None when agents are disabled, cannot run in the container, or could
+    not be started recently.
+    """
+    if not FILE_AGENT_ENABLED:
+        return None
+    container_id = docker_container.id
+    with _agents_lock:
+        if container_id in _unsupported:
+            return None
+        agent = _agents.get(container_id)
+        if agent is not None and agent.alive:
+            return agent
+        if agent is not None and not agent.answered:
+            # The helper exited before its first response (e.g. no python3 in the image)
+            _unsupported.add(container_id)
+            return None
+        if time.monotonic() - _failed_at.get(container_id, -FILE_AGENT_RETRY_SECONDS) < FILE_AGENT_RETRY_SECONDS:
+            return None
+        starting = _starting.get(container_id)
+        if starting is None:
+            starting = _starting[container_id] = Future()
+            started_here = True
+        else:
+            started_here = False
+    if not started_here:
+        try:
+            return starting.result(timeout=FILE_AGENT_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            return None
+    agent = None
+    try:
+        agent = FileAgent(docker_container)
+    except Exception as e:
+        # Possibly transient (API timeout, container restarting), so retried later
+        print(f"File agent unavailable for {container_id}: {e}")
+    with _agents_lock:
+        # close_file_agent() during the start drops it, as the container stopped
+        registered = _starting.get(container_id) is starting
+        if registered:
+            del _starting[container_id]
+            if agent is not None:
+                _agents[container_id] = agent
+            else:
+                _failed_at[container_id] = time.monotonic()
+    if not registered and agent is not None:
+        agent.close()
+        agent = None
+    starting.set_result(agent)
+    return agent
+
+def close_file_agent(container_id: str):
+    with _agents_lock:
+        agent = _agents.pop(container_id, None)
+        _unsupported.discard(container_id)
+        _starting.pop(container_id, None)
+        _failed_at.pop(container_id, None)
+    if agent is not None:
+        agent.close()
+
+# Exec fallback for file operations when no agent is available. The argv is passed
+# as a list, so paths are never split or interpreted by a shell.
+FILE_OPERATION_COMMANDS = {
+    "mkdir": lambda path: ["mkdir", "-p", "--", path],
+    "touch": lambda path: ["touch", "--", path],
+    "move": lambda source, destination: ["mv", "--", source, destination],
+    "remove": lambda path: ["rm", "-rf", "--", path],
+}
+
+def run_file_operation(docker_container, op: str, **args) -> bool:
+    """
+    Run a file operation through the agent, or with one exec as a fallback.
+    Returns whether the operation succeeded.
+    """
+    agent = get_file_agent(docker_container)
+    if agent is not None:
+        try:
+            agent.request(op, **args)
+            return True
+        except FileAgentError as e:
+            print(f"File agent {op} failed: {e}")
+            if agent.alive:
+                return False
+    exec_result = docker_container.exec_run(FILE_OPERATION_COMMANDS[op](**args))
+    return exec_result.exit_code == 0
+
+def read_file_content(docker_container, path: str) -> bytes:
+    """
+    Read a whole file through the agent, or through the archive API as a fallback.
+    Raises FileAgentError, docker.errors.NotFound or IsADirectoryError on failure.
+    """
+    agent = get_file_agent(docker_container)
+    if agent is not None:
+        try:
+            return base64.b64decode(agent.request("read", path=path))
+        except FileAgentError:
+            if agent.alive:
+                raise
+    return read_file(docker_container, path)
+
+def stat_file(docker_container, path: str) -> Optional[tuple[int, float]]:
+    """
+    Return the size and mtime of a file, or None when it does not exist.
+    """
+    agent = get_file_agent(docker_container)
+    if agent is not None:
+        try:
+            size, mtime = agent.request("stat", path=path)
+            return size, mtime
+        except FileAgentError:
+            if agent.alive:
+                return None
+    entry = stat_paths(docker_container, [path]).get(path)
+    return (entry.size, entry.mtime) if entry is not None else None
+
+def read_file_version(docker_container, path: str) -> tuple[bytes, Optional[tuple[int, float]]]:
+    """
+    Read a whole file along with its size and mtime, as read_file_content does.
+    """
+    # Stat first: a change between the two calls then leaves an outdated version,
+    # which only makes the content look stale, never the other way around
+    version = stat_file(docker_container, path)
+    return read_file_content(docker_container, path), version
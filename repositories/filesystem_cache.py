@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+from repositories.filesystem_repository import WORKSPACE_ROOT, FileEntry
+
+# Cache limits: number of containers, total entries across all trees and
+# seconds before a tree is rescanned to pick up changes made from the terminal
+FILESYSTEM_CACHE_MAX_CONTAINERS = 64
+FILESYSTEM_CACHE_MAX_ENTRIES = 1_000_000
+FILESYSTEM_CACHE_TTL_SECONDS = 10
+
+# Versions are global so an ETag is never reused, even after eviction
+_versions = itertools.count(1)
+
+def normalize_path(path: str) -> str:
+    return posixpath.normpath(path)
+
+def _in_subtree(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+def listing_key(entry: FileEntry) -> tuple[bool, str]:
+    """
+    Stable listing order: directories first, then by path.
+    """
+    return entry.kind != 'directory', entry.path
+
+class FileSystemTree:
+    def __init__(self, entries: Iterable[FileEntry], root: str = WORKSPACE_ROOT):
+        self.root = root
+        self.entries: dict[str, FileEntry] = {}
+        # Child paths per directory so listings and subtree edits cost O(children)
+        self.children: dict[str, set[str]] = {}
+        for entry in entries:
+            self._add(entry)
+        self.loaded_at = time.monotonic()
+        self.version = next(_versions)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+    def bump(self):
+        self.version = next(_versions)
+
+    def _add(self, entry: FileEntry):
+        if entry.path != self.root:
+            self.children.setdefault(posixpath.dirname(entry.path), set()).add(entry.path)
+        self.entries[entry.path] = entry
+
+    def upsert(self, entry: FileEntry):
+        if not _in_subtree(entry.path, self.root):
+            return
+        # Add missing parent directories like mkdir -p would
+        missing = []
+        parent = posixpath.dirname(entry.path)
+        while _in_subtree(parent, self.root) and parent not in self.entries:
+            missing.append(FileEntry(parent, 'directory', 0, entry.mtime, 0o755))
+            parent = posixpath.dirname(parent)
+        for directory in reversed(missing):
+            self._add(directory)
+        self._add(entry)
+
+    def subtree(self, path: str) -> list[FileEntry]:
+        if path not in self.entries:
+            return []
+        entries = []
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            entries.append(self.entries[current])
+            pending.extend(self.children.get(current, ()))
+        return entries
+
+    def list_directory(self, path: str, depth: int = 1) -> list[FileEntry]:
+        entries = []
+        level = [path]
+        for _ in range(depth):
+            level = [child for parent in level for child in self.children.get(parent, ())]
+            entries.extend(self.entries[child] for child in level)
+        return entries
+
+    def remove(self, path: str):
+        for entry in self.subtree(path):
+            del self.entries[entry.path]
+            self.children.pop(entry.path, None)
+        siblings = self.children.get(posixpath.dirname(path))
+        if siblings is not None:
+            siblings.discard(path)
+
+    def move(self, source: str, destination: str):
+        # mv into an existing directory keeps the source name
+        destination_entry = self.entries.get(destination)
+        if destination_entry and destination_entry.kind == 'directory':
+            destination = posixpath.join(destination, posixpath.basename(source))
+        moved = self.subtree(source)
+        self.remove(source)
+        for entry in moved:
+            self.upsert(entry._replace(path=destination + entry.path[len(source):]))
+
+class FileSystemCache:
+    """
+    LRU cache of container filesystem trees keyed by container_id.
+    """
+    def __init__(self, max_containers: int = FILESYSTEM_CACHE_MAX_CONTAINERS, max_entries: int = FILESYSTEM_CACHE_MAX_ENTRIES, ttl: float = FILESYSTEM_CACHE_TTL_SECONDS):
+        self.max_containers = max_containers
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._trees: OrderedDict[str, FileSystemTree] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, container_id: str) -> Optional[FileSystemTree]:
+        tree = self._trees.get(container_id)
+        if tree is None:
+            return None
+        if time.monotonic() - tree.loaded_at > self.ttl:
+            del self._trees[container_id]
+            return None
+        self._trees.move_to_end(container_id)
+        return tree
+
+    def read(self, container_id: str) -> Optional[tuple[str, list[FileEntry]]]:
+        """
+        Return the ETag and a copy of the entries of a fresh cached tree.
+        """
+        with self._lock:
+            tree = self._get(container_id)
+            if tree is None:
+                return None
+            return tree.etag, list(tree.entries.values())
+
+    def lookup(self, container_id: str, paths: Iterable[str]) -> dict[str, FileEntry]:
+        """
+        Return the cached entries of the given paths that are known.
+        """
+        with self._lock:
+            tree = self._get(container_id)
+            if tree is None:
+                return {}
+            return {path: tree.entries[path] for path in paths if path in tree.entries}
+
+    def list_directory(self, container_id: str, path: str, depth: int = 1) -> Optional[tuple[str, Optional[list[FileEntry]]]]:
+        """
+        Return the ETag and entries under path down to depth levels, or None when
+        the path is not covered by a fresh cached tree.
+        The entries are None when path is not a directory of the cached tree.
+        """
+        path = normalize_path(path)
+        with self._lock:
+            tree = self._get(container_id)
+            if tree is None or not _in_subtree(path, tree.root):
+                return None
+            entry = tree.entries.get(path)
+            if entry is None or entry.kind != 'directory':
+                return tree.etag, None
+            return tree.etag, tree.list_directory(path, depth)
+
+    def put(self, container_id: str, tree: FileSystemTree):
+        with self._lock:
+            self._trees[container_id] = tree
+            self._trees.move_to_end(container_id)
+            self._evict()
+
+    def _evict(self):
+        total = sum(len(tree.entries) for tree in self._trees.values())
+        while self._trees and (len(self._trees) > self.max_containers or total > self.max_entries):
+            _, tree = self._trees.popitem(last=False)
+            total -= len(tree.entries)
+
+    def invalidate(self, container_id: str):
+        with self._lock:
+            self._trees.pop(container_id, None)
+
+    def _patch(self, container_id: str, apply):
+        with self._lock:
+            tree = self._get(container_id)
+            if tree is None:
+                return
+            apply(tree)
+            tree.bump()
+
+    def upsert(self, container_id: str, entry: FileEntry):
+        entry = entry._replace(path=normalize_path(entry.path))
+        self._patch(container_id, lambda tree: tree.upsert(entry))
+
+    def touch(self, container_id: str, path: str):
+        path = normalize_path(path)
+        def apply(tree: FileSystemTree):
+            # touch only updates the mtime of an existing file or directory
+            existing = tree.entries.get(path) or FileEntry(path, 'file', 0, 0.0)
+            tree.upsert(existing._replace(mtime=time.time()))
+        self._patch(container_id, apply)
+
+    def remove(self, container_id: str, path: str):
+        self._patch(container_id, lambda tree: tree.remove(normalize_path(path)))
+
+    def move(self, container_id: str, source: str, destination: str):
+        self._patch(container_id, lambda tree: tree.move(normalize_path(source), normalize_path(destination)))
+
+filesystem_cache = FileSystemCache()
+
+# File content cache limits, used as the base for delta saves
+FILE_CONTENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FILE_CONTENT_CACHE_MAX_FILE_BYTES = 8 * 1024 * 1024
+FILE_CONTENT_CACHE_TTL_SECONDS = 30
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class FileContentCache:
+    """
+    LRU cache of recently read or saved file contents keyed by (container_id, path),
+    bounded by total bytes. Each content is stored with the size and mtime the file had,
+    when known, so callers can check that the file was not changed since.
+    """
+    def __init__(self, max_bytes: int = FILE_CONTENT_CACHE_MAX_BYTES, max_file_bytes: int = FILE_CONTENT_CACHE_MAX_FILE_BYTES, ttl: float = FILE_CONTENT_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.ttl = ttl
+        self._files: OrderedDict[tuple[str, str], tuple[str, bytes, Optional[tuple[int, float]], float]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, container_id: str, path: str) -> Optional[tuple[str, bytes, Optional[tuple[int, float]]]]:
+        """
+        Return the hash, content and version of a fresh cached file.
+        """
+        key = (container_id, normalize_path(path))
+        with self._lock:
+            cached = self._files.get(key)
+            if cached is None:
+                return None
+            digest, data, version, stored_at = cached
+            if time.monotonic() - stored_at > self.ttl:
+                self._drop(key)
+                return None
+            self._files.move_to_end(key)
+            return digest, data, version
+
+    def put(self, container_id: str, path: str, data: bytes, version: Optional[tuple[int, float]] = None) -> str:
+        digest = content_hash(data)
+        key = (container_id, normalize_path(path))
+        with self._lock:
+            self._drop(key)
+            if len(data) <= self.max_file_bytes:
+                self._files[key] = (digest, data, version, time.monotonic())
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._files)))
+        return digest
+
+    def _drop(self, key: tuple[str, str]):
+        cached = self._files.pop(key, None)
+        if cached is not None:
+            self._bytes -= len(cached[1])
+
+    def remove(self, container_id: str, path: str):
+        path = normalize_path(path)
+        with self._lock:
+            for key in [key for key in self._files if key[0] == container_id and _in_subtree(key[1], path)]:
+                self._drop(key)
+
+file_content_cache = FileContentCache()
@@ -0,0 +1,204 @@
+import io
+import posixpath
+import tarfile
+import time
+import zlib
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+WORKSPACE_ROOT = "/app"
+
+# find prints one NUL-terminated record per entry: type, size, mtime, mode and path.
+# The path goes last so tabs inside names survive the split, and NUL is the only
+# byte that can never appear in a path, so spaces and newlines are safe too.
+SNAPSHOT_FORMAT = "%y\\t%s\\t%T@\\t%m\\t%p\\0"
+
+KINDS = {"d": "directory", "f": "file"}
+
+class FileEntry(NamedTuple):
+    path: str
+    kind: str
+    size: int
+    mtime: float
+    mode: int = 0o644
+
+# Build the argv for a single find run (no shell, no TTY)
+def snapshot_command(root: str = WORKSPACE_ROOT, max_depth: Optional[int] = None, paths: Optional[list[str]] = None) -> list[str]:
+    command = ["find", *(paths or [root])]
+    if max_depth is not None:
+        command += ["-maxdepth", str(max_depth)]
+    return command + ["-printf", SNAPSHOT_FORMAT]
+
+def _parse_record(record: bytes) -> Optional[FileEntry]:
+    try:
+        kind, size, mtime, mode, path = record.decode("utf-8", "replace").split("\t", 4)
+        kind = KINDS.get(kind)
+        if kind is None:
+            return None
+        return FileEntry(path, kind, int(size), float(mtime), int(mode, 8))
+    except ValueError:
+        return None
+
+# Parse find output chunk by chunk, never holding more than one partial record
+def parse_snapshot(chunks: Iterable[bytes]) -> Iterator[FileEntry]:
+    pending = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        records = (pending + chunk).split(b"\0")
+        pending = records.pop()
+        for record in records:
+            entry = _parse_record(record)
+            if entry is not None:
+                yield entry
+    if pending:
+        entry = _parse_record(pending)
+        if entry is not None:
+            yield entry
+
+# List the entries under path down to max_depth levels, without the path itself.
+# Returns None when path does not exist or is not a directory.
+def scan_directory(docker_container, path: str, max_depth: int = 1) -> Optional[list[FileEntry]]:
+    entries = []
+    found = False
+    for entry in scan_filesystem(docker_container, path, max_depth):
+        if entry.path == path:
+            found = entry.kind == 'directory'
+        else:
+            entries.append(entry)
+    return entries if found else None
+
+# Stream a snapshot of the container filesystem with one exec
+def scan_filesystem(docker_container, root: str = WORKSPACE_ROOT, max_depth: Optional[int] = None) -> Iterator[FileEntry]:
+    exec_result = docker_container.exec_run(snapshot_command(root, max_depth), stream=True, demux=True)
+    return parse_snapshot(stdout for stdout, _ in exec_result.output if stdout)
+
+# Stat several paths with one exec. Missing paths are left out of the result.
+def stat_paths(docker_container, paths: list[str]) -> dict[str, FileEntry]:
+    exec_result = docker_container.exec_run(snapshot_command(max_depth=0, paths=paths), stream=True, demux=True)
+    return {entry.path: entry for entry in parse_snapshot(stdout for stdout, _ in exec_result.output if stdout)}
+
+# List several directories with everything under them with one exec.
+def scan_paths(docker_container, paths: list[str]) -> list[FileEntry]:
+    exec_result = docker_container.exec_run(snapshot_command(paths=paths), stream=True, demux=True)
+    return list(parse_snapshot(stdout for stdout, _ in exec_result.output if stdout))
+
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+# os.ModeDir bit of the Go file mode reported in the archive stat header
+ARCHIVE_MODE_DIR = 1 << 31
+
+class FileStat(NamedTuple):
+    path: str
+    size: int
+    mode: int
+    mtime: str
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.mode & ARCHIVE_MODE_DIR)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.size:x}-{zlib.crc32(self.mtime.encode()):x}"'
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of byte chunks.
+    """
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            self._pending = next(self._chunks, b"")
+            if not self._pending:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+# Open a file through the container archive API. Symlinks are followed once.
+# Returns the file stat and the raw tar stream, which must be consumed or closed.
+def open_file(docker_container, path: str, follow_links: bool = True) -> tuple[FileStat, Iterator[bytes]]:
+    stream, stat = docker_container.get_archive(path, chunk_size=ARCHIVE_CHUNK_SIZE)
+    link_target = stat.get('linkTarget')
+    if follow_links and link_target:
+        stream.close()
+        return open_file(docker_container, posixpath.join(posixpath.dirname(path), link_target), follow_links=False)
+    return FileStat(path, stat.get('size', 0), stat.get('mode', 0), stat.get('mtime', '')), stream
+
+# Stream the content of the single file in a tar stream, from start for length bytes
+def iter_file_content(stream: Iterator[bytes], start: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    try:
+        with tarfile.open(fileobj=_ChunkReader(stream), mode='r|') as tar:
+            member = tar.next()
+            fileobj = tar.extractfile(member) if member is not None else None
+            if fileobj is None:
+                return
+            while start > 0:
+                skipped = len(fileobj.read(min(start, ARCHIVE_CHUNK_SIZE)))
+                if not skipped:
+                    return
+                start -= skipped
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = fileobj.read(ARCHIVE_CHUNK_SIZE if remaining is None else min(remaining, ARCHIVE_CHUNK_SIZE))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+    finally:
+        stream.close()
+
+def read_file(docker_container, path: str) -> bytes:
+    stat, stream = open_file(docker_container, path)
+    if stat.is_dir:
+        stream.close()
+        raise IsADirectoryError(path)
+    return b"".join(iter_file_content(stream))
+
+class FileUpload(NamedTuple):
+    path: str
+    data: bytes
+    mode: int = 0o644
+
+# Yield a tar stream of the uploads block by block, without building it in memory.
+# The files get the given mtime, whole seconds by default.
+def iter_tar(uploads: Iterable[FileUpload], mtime: Optional[int] = None) -> Iterator[bytes]:
+    mtime = int(time.time()) if mtime is None else mtime
+    for upload in uploads:
+        tarinfo = tarfile.TarInfo(name=upload.path.lstrip('/'))
+        tarinfo.size = len(upload.data)
+        tarinfo.mode = upload.mode
+        tarinfo.mtime = mtime
+        yield tarinfo.tobuf()
+        yield upload.data
+        padding = -len(upload.data) % tarfile.BLOCKSIZE
+        if padding:
+            yield b"\0" * padding
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+# Write files at absolute paths with a single put_archive; missing parents are created
+def write_files(docker_container, uploads: list[FileUpload], mtime: Optional[int] = None) -> bool:
+    return docker_container.put_archive(path="/", data=iter_tar(uploads, mtime))
+
+# Apply (start, end, text) replacements to a text. Offsets refer to the base text in
+# UTF-16 code units, as JavaScript editors report them, and must not overlap.
+def apply_text_edits(base: str, edits: Iterable[tuple[int, int, str]]) -> str:
+    units = base.encode("utf-16-le", "surrogatepass")
+    parts = []
+    position = 0
+    for start, end, text in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        if start < position or end < start or end * 2 > len(units):
+            raise ValueError("Edits overlap or are out of range")
+        parts.append(units[position * 2:start * 2])
+        parts.append(text.encode("utf-16-le", "surrogatepass"))
+        position = end
+    parts.append(units[position * 2:])
+    return b"".join(parts).decode("utf-16-le", "surrogatepass")
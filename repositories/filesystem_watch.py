@@ -0,0 +1,368 @@
+import asyncio
+import json
+import posixpath
+import struct
+import time
+from typing import Callable, Optional
+from repositories.connections import Connection, ConnectionManager
+from repositories.docker_repository import DockerEngine
+from repositories.filesystem_cache import FileSystemTree, _in_subtree, file_content_cache, filesystem_cache
+from repositories.filesystem_repository import WORKSPACE_ROOT, FileEntry, scan_filesystem, scan_paths, stat_paths
+from repositories.terminal import ExecSocket
+
+# Changes are sent once the workspace is quiet for the debounce window, or at the latest
+# after the maximum delay. Batches over the event limit are replaced by a resync message.
+FILESYSTEM_WATCH_DEBOUNCE_SECONDS = 0.2
+FILESYSTEM_WATCH_MAX_DELAY_SECONDS = 1
+FILESYSTEM_WATCH_MAX_EVENTS = 1000
+# Seconds for inotifywait to set up its watches before falling back to polling
+FILESYSTEM_WATCH_START_TIMEOUT_SECONDS = 30
+# Seconds between snapshots of containers without inotifywait
+FILESYSTEM_POLL_SECONDS = 2
+
+# Runs inotifywait until the exec stdin closes. Records are "EVENTS\tPATH\0" on stdout,
+# and inotifywait prints "Watches established." on stderr once every directory is watched.
+INOTIFY_SCRIPT = f'''
+command -v inotifywait >/dev/null || exit 127
+inotifywait -m -r --no-newline --format "%e\t%w%f%0" -e create -e modify -e delete -e moved_from -e moved_to {WORKSPACE_ROOT} & watcher=$!
+(cat >/dev/null; kill $watcher) >/dev/null 2>&1 &
+wait $watcher
+'''
+
+class InotifyUnavailableError(Exception):
+    pass
+
+def entry_details(entry: FileEntry) -> dict:
+    return {"kind": entry.kind, "size": entry.size, "mtime": entry.mtime, "mode": entry.mode}
+
+def event_entry(event: dict) -> FileEntry:
+    return FileEntry(event["path"], event["kind"], event["size"], event["mtime"], event["mode"])
+
+class FileSystemWatcher:
+    """
+    Watches the workspace of one container and publishes batches of create, modify,
+    delete and move events. Uses inotifywait in the container when it is installed,
+    otherwise diffs snapshots taken every few seconds.
+    """
+    def __init__(self, container_id: str, docker_engine: DockerEngine, docker_container, publish: Callable[[dict], None], on_close: Optional[Callable[["FileSystemWatcher"], None]] = None):
+        self.container_id = container_id
+        self.engine = docker_engine
+        self.docker_container = docker_container
+        self.publish = publish
+        self.source: Optional[str] = None
+        self._on_close = on_close
+        self._events: list[dict] = []
+        # Position of the pending create or modify event of each path, merged on repeat
+        self._upserts: dict[str, int] = {}
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._exec_socket: Optional[ExecSocket] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+        # Batches are published one at a time, in order
+        self._flush_lock = asyncio.Lock()
+
+    def start(self):
+        self._spawn(self._run())
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        try:
+            try:
+                await self._watch_inotify()
+            except InotifyUnavailableError as e:
+                print(f"Watching {self.container_id} by polling: {e}")
+                await self._watch_polling()
+        except Exception as e:
+            print(f"Filesystem watcher of {self.container_id} stopped: {e}")
+        # Only reached when the watcher ends by itself, e.g. the container stopped
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _set_ready(self, source: str):
+        self.source = source
+        self.publish({"type": "ready", "source": source})
+
+    async def _open_inotify(self) -> ExecSocket:
+        api = self.docker_container.client.api
+        exec_id = (await self.engine.run(api.exec_create, self.docker_container.id, ["sh", "-c", INOTIFY_SCRIPT], stdin=True, stdout=True, stderr=True, tty=False, operation="exec"))['Id']
+        return ExecSocket(await self.engine.run(api.exec_start, exec_id, socket=True, operation="exec"))
+
+    async def _read_frames(self):
+        # Frames of the multiplexed stream: stream type, 3 zero bytes, size, payload
+        pending = bytearray()
+        while True:
+            while len(pending) >= 8:
+                size = struct.unpack(">L", pending[4:8])[0]
+                if len(pending) < 8 + size:
+                    break
+                yield pending[0], bytes(pending[8:8 + size])
+                del pending[:8 + size]
+            data = await self._exec_socket.recv()
+            if not data:
+                return
+            pending += data
+
+    async def _watch_inotify(self):
+        self._exec_socket = await self._open_inotify()
+        frames = self._read_frames()
+        established = False
+        errors = b''
+        records = b''
+        deadline = time.monotonic() + FILESYSTEM_WATCH_START_TIMEOUT_SECONDS
+        try:
+            while True:
+                try:
+                    if established:
+                        stream, payload = await frames.__anext__()
+                    else:
+                        stream, payload = await asyncio.wait_for(frames.__anext__(), max(0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    if not established:
+                        raise InotifyUnavailableError(errors.decode('utf-8', 'replace').strip() or "inotifywait is not installed")
+                    return
+                except asyncio.TimeoutError:
+                    raise InotifyUnavailableError("inotifywait did not start in time")
+                if stream == 2:
+                    errors = (errors + payload)[-4096:]
+                    if not established and b'Watches established' in errors:
+                        established = True
+                        self._set_ready("inotify")
+                    continue
+                *complete, records = (records + payload).split(b'\0')
+                for record in complete:
+                    self._add_inotify_record(record.decode('utf-8', 'replace'))
+        finally:
+            # Closing stdin makes the script stop inotifywait
+            self._exec_socket.close()
+
+    def _add_inotify_record(self, record: str):
+        flags, _, path = record.partition('\t')
+        if not path:
+            return
+        path = posixpath.normpath(path)
+        flags = set(flags.split(','))
+        kind = 'directory' if 'ISDIR' in flags else 'file'
+        if 'MOVED_FROM' in flags:
+            # Becomes a move if the MOVED_TO follows, otherwise it left the workspace
+            self._add({"type": "delete", "path": path, "kind": kind, "moved": True})
+        elif 'MOVED_TO' in flags:
+            last = self._events[-1] if self._events else None
+            if last is not None and last.pop("moved", False) and last["kind"] == kind:
+                self._events.pop()
+                self._add({"type": "move", "from": last["path"], "path": path, "kind": kind})
+            else:
+                self._add({"type": "create", "path": path, "kind": kind})
+        elif 'CREATE' in flags:
+            self._add({"type": "create", "path": path, "kind": kind})
+        elif 'DELETE' in flags:
+            self._add({"type": "delete", "path": path, "kind": kind})
+        elif 'MODIFY' in flags:
+            self._add({"type": "modify", "path": path, "kind": kind})
+
+    async def _watch_polling(self):
+        previous = await self._snapshot()
+        self._set_ready("poll")
+        while True:
+            await asyncio.sleep(FILESYSTEM_POLL_SECONDS)
+            current = await self._snapshot()
+            changed = False
+            for path, entry in previous.items():
+                if path not in current:
+                    self._add({"type": "delete", "path": path, "kind": entry.kind})
+                    changed = True
+            for path, entry in current.items():
+                old = previous.get(path)
+                if old != entry:
+                    self._add({"type": "create" if old is None else "modify", "path": path, **entry_details(entry)})
+                    changed = True
+            if changed:
+                # The snapshot is complete, so it also replaces the cached tree
+                filesystem_cache.put(self.container_id, FileSystemTree(current.values()))
+            previous = current
+
+    async def _snapshot(self) -> dict[str, FileEntry]:
+        entries = await self.engine.run(lambda: {entry.path: entry for entry in scan_filesystem(self.docker_container)}, operation="filesystem")
+        if WORKSPACE_ROOT not in entries:
+            raise RuntimeError(f"{WORKSPACE_ROOT} is not available")
+        return entries
+
+    def _add(self, event: dict):
+        path = event["path"]
+        if event["type"] in ("create", "modify"):
+            index = self._upserts.get(path)
+            if index is not None:
+                # A create followed by modifies stays a create, with the latest details
+                self._events[index].update({key: value for key, value in event.items() if key != "type"})
+            else:
+                self._upserts[path] = len(self._events)
+                self._events.append(event)
+        else:
+            # Events after a delete or move of the path, or of a parent, must not merge into earlier ones
+            for root in (path, event.get("from")):
+                if root is not None:
+                    for pending in [pending for pending in self._upserts if _in_subtree(pending, root)]:
+                        del self._upserts[pending]
+            self._events.append(event)
+        now = time.monotonic()
+        if self._timer is None:
+            self._first_event = now
+            self._timer = self._spawn(self._flush_later())
+        self._last_event = now
+
+    async def _flush_later(self):
+        while True:
+            flush_at = min(self._last_event + FILESYSTEM_WATCH_DEBOUNCE_SECONDS, self._first_event + FILESYSTEM_WATCH_MAX_DELAY_SECONDS)
+            now = time.monotonic()
+            if now >= flush_at:
+                break
+            await asyncio.sleep(flush_at - now)
+        events, self._events, self._upserts = self._events, [], {}
+        self._timer = None
+        async with self._flush_lock:
+            await self._flush(events)
+
+    def _resync(self):
+        filesystem_cache.invalidate(self.container_id)
+        self.publish({"type": "resync"})
+
+    async def _flush(self, events: list[dict]):
+        for event in events:
+            event.pop("moved", None)
+        if len(events) > FILESYSTEM_WATCH_MAX_EVENTS:
+            self._resync()
+            return
+        if self.source == "inotify":
+            try:
+                events = await self._add_details(events)
+            except Exception as e:
+                print(f"Error reading changed paths of {self.container_id}: {e}")
+                self._resync()
+                return
+            if len(events) > FILESYSTEM_WATCH_MAX_EVENTS:
+                self._resync()
+                return
+            self._patch_cache(events)
+        if not events:
+            return
+        for event in events:
+            if "from" in event:
+                file_content_cache.remove(self.container_id, event["from"])
+            file_content_cache.remove(self.container_id, event["path"])
+        self.publish({"type": "changes", "events": events})
+
+    async def _add_details(self, events: list[dict]) -> list[dict]:
+        # inotify only reports paths. Directories that appear may already hold files
+        # created before they were watched, so they are listed with their contents.
+        directories = [event["path"] for event in events if event["type"] == "create" and event["kind"] == "directory"]
+        paths = [event["path"] for event in events if event["type"] != "delete" and event["path"] not in directories]
+        entries = await self.engine.run(stat_paths, self.docker_container, paths, operation="filesystem") if paths else {}
+        contents: dict[str, list[FileEntry]] = {}
+        if directories:
+            for entry in await self.engine.run(scan_paths, self.docker_container, directories, operation="filesystem"):
+                entries[entry.path] = entry
+                parent = next((directory for directory in directories if _in_subtree(entry.path, directory) and entry.path != directory), None)
+                if parent is not None:
+                    contents.setdefault(parent, []).append(entry)
+        reported = {event["path"] for event in events}
+        detailed = []
+        for event in events:
+            if event["type"] == "delete":
+                detailed.append(event)
+                continue
+            entry = entries.get(event["path"])
+            if entry is None:
+                # Gone again before the lookup, its delete event follows
+                continue
+            event.update(entry_details(entry))
+            detailed.append(event)
+            for child in contents.pop(event["path"], ()):
+                if child.path not in reported:
+                    reported.add(child.path)
+                    detailed.append({"type": "create", "path": child.path, **entry_details(child)})
+        return detailed
+
+    def _patch_cache(self, events: list[dict]):
+        for event in events:
+            if event["type"] == "delete":
+                filesystem_cache.remove(self.container_id, event["path"])
+            elif event["type"] == "move":
+                # The event names the final path, which a rename replaces if it exists
+                filesystem_cache.remove(self.container_id, event["path"])
+                filesystem_cache.move(self.container_id, event["from"], event["path"])
+                filesystem_cache.upsert(self.container_id, event_entry(event))
+            else:
+                filesystem_cache.upsert(self.container_id, event_entry(event))
+
+class FileSystemWatchManager:
+    """
+    Change notification subscribers by container, with one watcher per container that
+    runs while it has subscribers. Slow subscribers are disconnected rather than skipped,
+    since a missed change would leave their tree out of date.
+    """
+    def __init__(self):
+        self.connections = ConnectionManager(slow_consumer_policy="disconnect")
+        self._watchers: dict[str, FileSystemWatcher] = {}
+
+    async def subscribe(self, websocket, container_id: str, user_id: int, docker_engine: DockerEngine, docker_container) -> Connection:
+        connection = await self.connections.connect(websocket, container_id, user_id)
+        watcher = self._watchers.get(container_id)
+        if watcher is None:
+            watcher = FileSystemWatcher(container_id, docker_engine, docker_container, lambda message: self._publish(container_id, message), self._closed)
+            self._watchers[container_id] = watcher
+            watcher.start()
+        elif watcher.source is not None:
+            connection.offer(json.dumps({"type": "ready", "source": watcher.source}))
+        return connection
+
+    def _publish(self, container_id: str, message: dict):
+        self.connections.broadcast(json.dumps(message), container_id=container_id)
+
+    def _closed(self, watcher: FileSystemWatcher):
+        # Subscribers reconnect once the container is back and load the tree again
+        if self._watchers.get(watcher.container_id) is watcher:
+            del self._watchers[watcher.container_id]
+        for connection in self.connections.select(container_id=watcher.container_id):
+            self.connections.disconnect(connection)
+            asyncio.get_running_loop().create_task(connection.abort(1011, "Filesystem watch ended"))
+
+    async def close_container(self, container_id: str, code: int, reason: str):
+        """
+        Stop the watcher of a container and close its subscribers with the given code,
+        e.g. before the container is suspended, so they do not reconnect at once.
+        """
+        watcher = self._watchers.pop(container_id, None)
+        for connection in self.connections.select(container_id=container_id):
+            self.connections.disconnect(connection)
+            await connection.abort(code, reason)
+        if watcher is not None:
+            await watcher.stop()
+
+    async def unsubscribe(self, connection: Connection):
+        self.connections.disconnect(connection)
+        container_id = connection.container_id
+        if not self.connections.count(container_id=container_id):
+            watcher = self._watchers.pop(container_id, None)
+            if watcher is not None:
+                await watcher.stop()
+
+    def stats(self) -> dict:
+        return {"watchers": len(self._watchers), **self.connections.stats()}
+
+    async def stop(self):
+        watchers, self._watchers = list(self._watchers.values()), {}
+        for watcher in watchers:
+            await watcher.stop()
+
+filesystem_watch = FileSystemWatchManager()
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import time
+from typing import Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.container import Container, ContainerStatus
+from repositories.database_repository import AsyncSessionLocal, get_container_docker_host
+from repositories.docker_hosts import DockerHost, DockerHostPool, docker_hosts
+from repositories.file_agent import close_file_agent
+from repositories.filesystem_watch import filesystem_watch
+from repositories.scheduler import ResourceScheduler, scheduler
+from repositories.terminal import terminal_sessions
+
+IDLE_TRACKER_ENABLED = os.environ.get("IDLE_TRACKER_ENABLED", "true").lower() == "true"
+# Seconds without terminal or file activity before a workspace is suspended
+IDLE_SUSPEND_SECONDS = int(os.environ.get("IDLE_SUSPEND_SECONDS", "1800"))
+# "stop" frees the container memory; "pause" only freezes its processes but resumes faster
+IDLE_SUSPEND_ACTION = os.environ.get("IDLE_SUSPEND_ACTION", "stop")
+IDLE_CHECK_SECONDS = 60
+# Seconds a request waits for a suspended workspace to come back
+IDLE_RESUME_TIMEOUT_SECONDS = 30
+
+# Docker and database status of a container suspended with each action
+SUSPENDED_STATUSES = {
+    "pause": ("paused", ContainerStatus.paused),
+    "stop": ("exited", ContainerStatus.exited),
+}
+
+class IdleTracker:
+    """
+    Records the last activity of each workspace and suspends the ones left idle.
+    Only containers suspended here are resumed on the next request; containers the
+    user stopped stay stopped.
+    """
+    def __init__(self, hosts: DockerHostPool, resources: ResourceScheduler, idle_seconds: float = IDLE_SUSPEND_SECONDS, action: str = IDLE_SUSPEND_ACTION):
+        if action not in SUSPENDED_STATUSES:
+            raise ValueError(f"Unknown idle suspend action: {action}")
+        self.hosts = hosts
+        self.resources = resources
+        self.idle_seconds = idle_seconds
+        self.action = action
+        self._last_activity: dict[str, float] = {}
+        # Action used for each container suspended by the tracker
+        self._suspended: dict[str, str] = {}
+        self._resuming: dict[str, asyncio.Task] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._check_task: Optional[asyncio.Task] = None
+
+    def touch(self, container_id: str):
+        self._last_activity[container_id] = time.monotonic()
+
+    def forget(self, container_id: str):
+        self._last_activity.pop(container_id, None)
+        self._suspended.pop(container_id, None)
+
+    def is_suspended(self, container_id: str) -> bool:
+        return container_id in self._suspended
+
+    def _lock(self, container_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(container_id, asyncio.Lock())
+
+    async def ensure_active(self, container_id: str, timeout: float = IDLE_RESUME_TIMEOUT_SECONDS):
+        """
+        Record activity and, if the tracker suspended the container, resume it.
+        Raises asyncio.TimeoutError when it is not back within timeout; the resume
+        keeps going in the background.
+        """
+        self.touch(container_id)
+        lock = self._locks.get(container_id)
+        if container_id not in self._suspended and (lock is None or not lock.locked()):
+            return
+        task = self._resuming.get(container_id)
+        if task is None:
+            task = self._resuming[container_id] = asyncio.get_running_loop().create_task(self._resume(container_id))
+            task.add_done_callback(lambda _: self._resuming.pop(container_id, None))
+        await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    async def _host(self, container_id: str) -> DockerHost:
+        async with AsyncSessionLocal() as db:
+            return self.hosts.get(await get_container_docker_host(db, container_id))
+
+    async def _resume(self, container_id: str):
+        async with self._lock(container_id):
+            action = self._suspended.get(container_id)
+            if action is None:
+                return
+            host = await self._host(container_id)
+            docker_container = await host.engine.get_container(container_id)
+            reservation = None
+            try:
+                if action == "pause" and docker_container.status == 'paused':
+                    await host.engine.run(docker_container.unpause, operation="start")
+                elif docker_container.status != 'running':
+                    # A stopped workspace gave its resources back, so it is admitted again
+                    reservation = await self.resources.admit_start(container_id)
+                    await host.engine.run(docker_container.start, operation="start")
+                del self._suspended[container_id]
+                host.events.statuses.set(container_id, 'running')
+                self.touch(container_id)
+                await self._save_status(container_id, ContainerStatus.running)
+            finally:
+                self.resources.release(reservation)
+
+    async def _suspend(self, container_id: str):
+        async with self._lock(container_id):
+            last_activity = self._last_activity.get(container_id)
+            if container_id in self._suspended or last_activity is None or time.monotonic() - last_activity < self.idle_seconds:
+                return
+            host = await self._host(container_id)
+            docker_container = await host.engine.get_container(container_id)
+            if docker_container.status != 'running':
+                # Stopped or paused by someone else, so not ours to resume
+                self.forget(container_id)
+                return
+            if self.action == "pause":
+                await host.engine.run(docker_container.pause, operation="stop")
+            else:
+                close_file_agent(container_id)
+                terminal_sessions.close_container(container_id)
+                # Watch subscribers reconnect after 1011, which would resume the container
+                await filesystem_watch.close_container(container_id, 1008, "Container suspended while idle")
+                await host.engine.run(docker_container.stop, operation="stop")
+            self._suspended[container_id] = self.action
+            docker_status, status = SUSPENDED_STATUSES[self.action]
+            host.events.statuses.set(container_id, docker_status)
+            await self._save_status(container_id, status)
+            self.resources.wake()
+            print(f"Suspended idle container {container_id} ({self.action})")
+
+    async def _save_status(self, container_id: str, status: ContainerStatus):
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(Container).where(Container.container_id == container_id).values(status=status))
+            await db.commit()
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(IDLE_CHECK_SECONDS)
+            now = time.monotonic()
+            for container_id, last_activity in list(self._last_activity.items()):
+                if container_id in self._suspended or now - last_activity < self.idle_seconds:
+                    continue
+                try:
+                    await self._suspend(container_id)
+                except Exception as e:
+                    print(f"Error suspending idle container {container_id}: {e}")
+                    self.forget(container_id)
+
+    async def start(self, db: AsyncSession):
+        # Containers already running count as active from now on
+        rows = await db.execute(select(Container.container_id).where(Container.status == ContainerStatus.running))
+        for container_id in rows.scalars():
+            self.touch(container_id)
+        self._check_task = asyncio.get_running_loop().create_task(self._check_loop())
+
+    async def stop(self):
+        if self._check_task is not None:
+            self._check_task.cancel()
+            try:
+                await self._check_task
+            except asyncio.CancelledError:
+                pass
+
+idle_tracker = IdleTracker(docker_hosts, scheduler)
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from typing import NamedTuple, Optional
+import docker
+from repositories.docker_repository import DockerEngine
+
+# Image used for new user containers
+DEFAULT_IMAGE = "javierhersan/code-ai"
+# Seconds a pulled image is considered fresh before it is pulled again in the background
+IMAGE_REFRESH_SECONDS = 3600
+# Seconds between checks for images due for a background refresh
+IMAGE_REFRESH_CHECK_SECONDS = 60
+# Seconds before an image is pulled again in the background after a failed pull
+IMAGE_PULL_RETRY_SECONDS = 300
+
+class LocalImage(NamedTuple):
+    digest: str
+    # When the copy was pulled, or found locally, by this process
+    checked_at: float
+
+class ImageManager:
+    """
+    Tracks the local copy of the images containers are created from. Concurrent pulls
+    of the same image share one daemon call, and requests never wait for a pull when a
+    local copy exists; stale copies are refreshed in the background.
+    """
+    def __init__(self, docker_engine: DockerEngine, refresh_seconds: float = IMAGE_REFRESH_SECONDS, retry_seconds: float = IMAGE_PULL_RETRY_SECONDS):
+        self.engine = docker_engine
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self._images: dict[str, LocalImage] = {}
+        self._pulls: dict[str, asyncio.Task] = {}
+        # When the last pull of each image failed, cleared by a successful pull
+        self._failed_at: dict[str, float] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _is_stale(self, image: LocalImage, now: float) -> bool:
+        return now - image.checked_at > self.refresh_seconds
+
+    def digest(self, image_name: str) -> Optional[str]:
+        image = self._images.get(image_name)
+        return image.digest if image else None
+
+    async def ensure(self, image_name: str) -> str:
+        """
+        Return the digest of a local copy of the image, pulling it only when there is none.
+        """
+        image = self._images.get(image_name)
+        if image is None:
+            try:
+                client = await self.engine.get_client()
+                local = await self.engine.run(client.images.get, image_name, operation="inspect")
+                # Fresh from now on; the refresh at startup keeps the default image current
+                image = self._images[image_name] = LocalImage(local.id, time.monotonic())
+            except docker.errors.ImageNotFound:
+                return await self.pull(image_name)
+        if self._is_stale(image, time.monotonic()):
+            self.refresh(image_name)
+        return image.digest
+
+    async def pull(self, image_name: str) -> str:
+        """
+        Pull the image and return its digest. Concurrent calls share the same pull.
+        """
+        task = self._pulls.get(image_name)
+        if task is None:
+            task = self._pulls[image_name] = asyncio.get_running_loop().create_task(self._pull(image_name))
+        # A cancelled request must not cancel the pull other requests wait on
+        return await asyncio.shield(task)
+
+    async def _pull(self, image_name: str) -> str:
+        try:
+            client = await self.engine.get_client()
+            image = await self.engine.run(client.images.pull, image_name, operation="pull")
+            self._images[image_name] = LocalImage(image.id, time.monotonic())
+            self._failed_at.pop(image_name, None)
+            return image.id
+        except Exception:
+            self._failed_at[image_name] = time.monotonic()
+            raise
+        finally:
+            self._pulls.pop(image_name, None)
+
+    def refresh(self, image_name: str):
+        """
+        Pull the image in the background unless a pull is already running or the
+        last one failed less than retry_seconds ago.
+        """
+        if image_name in self._pulls:
+            return
+        failed_at = self._failed_at.get(image_name)
+        if failed_at is not None and time.monotonic() - failed_at < self.retry_seconds:
+            return
+        task = self._pulls[image_name] = asyncio.get_running_loop().create_task(self._pull(image_name))
+        task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background image pull failed: {task.exception()}")
+
+    def start(self, image_names: tuple[str, ...] = (DEFAULT_IMAGE,)):
+        for image_name in image_names:
+            self.refresh(image_name)
+        self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(IMAGE_REFRESH_CHECK_SECONDS)
+            now = time.monotonic()
+            for image_name, image in list(self._images.items()):
+                if self._is_stale(image, now):
+                    self.refresh(image_name)
@@ -0,0 +1,145 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Optional
+
+# Jobs run at once; the rest wait with status "queued"
+JOB_CONCURRENCY = 16
+# Seconds finished jobs and their idempotency keys are kept for polling
+JOB_RETENTION_SECONDS = 3600
+
+class JobFailedError(Exception):
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class Job:
+    """
+    A container operation running in the background. Steps are appended as it
+    progresses and every change wakes the clients following it.
+    """
+    def __init__(self, owner: str, operation: str):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.operation = operation
+        self.status = "queued"
+        self.steps: list[dict] = []
+        self.result: Optional[dict] = None
+        self.error: Optional[dict] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        # Incremented on every change, so followers can tell what they have seen
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def progress(self, message: str):
+        self.steps.append({"time": time.time(), "message": message})
+        self._notify()
+
+    def _notify(self):
+        self.version += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_changed(self, version: int, timeout: float) -> bool:
+        """
+        Wait until the job changes after the given version. Returns False on timeout.
+        """
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "operation": self.operation,
+            "status": self.status,
+            "steps": self.steps,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobManager:
+    """
+    Runs jobs detached from the request that submitted them, so they complete even
+    if the client disconnects. Jobs submitted with the same idempotency key by the
+    same owner share one job while it is retained.
+    """
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, retention_seconds: float = JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._jobs: dict[str, Job] = {}
+        self._keys: dict[tuple[str, str], str] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def get(self, job_id: str, owner: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.owner == owner else None
+
+    def submit(self, owner: str, operation: str, work: Callable[[Job], Awaitable[dict]], idempotency_key: Optional[str] = None) -> Job:
+        """
+        Start work(job) in the background and return the job, or return the job
+        already submitted with the idempotency key.
+        """
+        self._prune()
+        if idempotency_key is not None:
+            job = self._jobs.get(self._keys.get((owner, idempotency_key)))
+            if job is not None:
+                return job
+        job = Job(owner, operation)
+        self._jobs[job.id] = job
+        if idempotency_key is not None:
+            self._keys[(owner, idempotency_key)] = job.id
+        job.task = asyncio.get_running_loop().create_task(self._run(job, work))
+        return job
+
+    async def _run(self, job: Job, work: Callable[[Job], Awaitable[dict]]):
+        async with self._semaphore:
+            job.status = "running"
+            job.progress("Started")
+            try:
+                job.result = await work(job)
+                job.status = "succeeded"
+            except JobFailedError as e:
+                job.error = {"status_code": e.status_code, "detail": e.detail}
+                job.status = "failed"
+            except asyncio.CancelledError:
+                job.error = {"status_code": 503, "detail": "Job cancelled by shutdown"}
+                job.status = "failed"
+                raise
+            except Exception as e:
+                job.error = {"status_code": 500, "detail": str(e)}
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                job.task = None
+                job._notify()
+
+    def _prune(self):
+        expired = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < expired:
+                del self._jobs[job_id]
+        for key, job_id in list(self._keys.items()):
+            if job_id not in self._jobs:
+                del self._keys[key]
+
+    async def stop(self):
+        # Jobs still running when the app shuts down are cancelled
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+jobs = JobManager()
@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import os
+from typing import NamedTuple, Optional
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.container import Container, ContainerStatus
+from repositories.database_repository import AsyncSessionLocal
+
+# Limits applied to each new container unless the request asks for others
+DEFAULT_CONTAINER_CPUS = float(os.environ.get("DEFAULT_CONTAINER_CPUS", "1"))
+DEFAULT_CONTAINER_MEMORY = int(os.environ.get("DEFAULT_CONTAINER_MEMORY", str(2 * 1024 ** 3)))
+MAX_CONTAINER_CPUS = 8
+MAX_CONTAINER_MEMORY = 32 * 1024 ** 3
+
+# Per-user quotas over the user's committed containers
+USER_MAX_CONTAINERS = int(os.environ.get("USER_MAX_CONTAINERS", "10"))
+USER_MAX_CPUS = float(os.environ.get("USER_MAX_CPUS", "4"))
+USER_MAX_MEMORY = int(os.environ.get("USER_MAX_MEMORY", str(8 * 1024 ** 3)))
+
+# Host capacity is read from the daemon and scaled by these ratios, unless set explicitly
+HOST_CPU_OVERCOMMIT = float(os.environ.get("HOST_CPU_OVERCOMMIT", "2"))
+HOST_MEMORY_OVERCOMMIT = float(os.environ.get("HOST_MEMORY_OVERCOMMIT", "1"))
+HOST_CPUS = os.environ.get("HOST_CPUS")
+HOST_MEMORY = os.environ.get("HOST_MEMORY")
+
+# How new containers are spread over Docker hosts: "least-loaded" or "hash" (by user)
+PLACEMENT_POLICY = os.environ.get("DOCKER_PLACEMENT_POLICY", "least-loaded")
+
+# Queued containers waiting for capacity, and seconds between admission checks
+MAX_QUEUED_CONTAINERS = 100
+SCHEDULER_CHECK_SECONDS = 5
+
+# Containers holding their resources: every status but exited
+COMMITTED_STATUSES = (ContainerStatus.created, ContainerStatus.running, ContainerStatus.paused, ContainerStatus.queued)
+
+class QuotaExceededError(Exception):
+    pass
+
+class CapacityExceededError(Exception):
+    pass
+
+class ResourceLimits(NamedTuple):
+    cpus: float
+    memory: int
+
+    def docker_options(self) -> dict:
+        return {"nano_cpus": int(self.cpus * 1e9), "mem_limit": self.memory}
+
+class ResourceUsage(NamedTuple):
+    containers: int
+    cpus: float
+    memory: int
+
+    def add(self, limits: ResourceLimits) -> "ResourceUsage":
+        return ResourceUsage(self.containers + 1, self.cpus + limits.cpus, self.memory + limits.memory)
+
+    def merge(self, other: "ResourceUsage") -> "ResourceUsage":
+        return ResourceUsage(self.containers + other.containers, self.cpus + other.cpus, self.memory + other.memory)
+
+DEFAULT_LIMITS = ResourceLimits(DEFAULT_CONTAINER_CPUS, DEFAULT_CONTAINER_MEMORY)
+
+def container_limits(container: Container) -> ResourceLimits:
+    return ResourceLimits(
+        container.cpu_limit if container.cpu_limit is not None else DEFAULT_CONTAINER_CPUS,
+        container.memory_limit if container.memory_limit is not None else DEFAULT_CONTAINER_MEMORY,
+    )
+
+async def committed_usage(db: AsyncSession, user_id: Optional[int] = None, statuses: tuple[ContainerStatus, ...] = COMMITTED_STATUSES, docker_host: Optional[str] = None) -> ResourceUsage:
+    """
+    Sum the limits of containers with the given statuses, for one user or one host.
+    Containers created before limits were stored count with the default limits.
+    """
+    query = select(
+        func.count(),
+        func.coalesce(func.sum(func.coalesce(Container.cpu_limit, DEFAULT_CONTAINER_CPUS)), 0),
+        func.coalesce(func.sum(func.coalesce(Container.memory_limit, DEFAULT_CONTAINER_MEMORY)), 0),
+    ).where(Container.status.in_(statuses))
+    if user_id is not None:
+        query = query.where(Container.user_id == user_id)
+    if docker_host is not None:
+        query = query.where(Container.docker_host == docker_host)
+    count, cpus, memory = (await db.execute(query)).one()
+    return ResourceUsage(count, float(cpus), int(memory))
+
+class Reservation(NamedTuple):
+    # Capacity taken by a container that is being created and has no row yet
+    user_id: int
+    host_name: str
+    status: ContainerStatus
+    limits: ResourceLimits
+
+def rendezvous_order(key: str, host_names: list[str]) -> list[str]:
+    """
+    Order hosts by highest random weight for the key. Adding or removing a host only
+    moves the keys that hash to it.
+    """
+    return sorted(host_names, key=lambda name: hashlib.sha256(f"{key}:{name}".encode()).digest(), reverse=True)
+
+class HostCapacity(NamedTuple):
+    cpus: Optional[float]
+    memory: Optional[int]
+
+    def fits(self, usage: ResourceUsage) -> bool:
+        return (self.cpus is None or usage.cpus <= self.cpus) and (self.memory is None or usage.memory <= self.memory)
+
+    def load(self, usage: ResourceUsage) -> float:
+        return max(usage.cpus / self.cpus if self.cpus else 0.0, usage.memory / self.memory if self.memory else 0.0)
+
+def host_capacity(info: dict) -> HostCapacity:
+    """
+    Capacity of a host from its daemon info, unless set explicitly.
+    """
+    return HostCapacity(
+        float(HOST_CPUS) if HOST_CPUS else info["NCPU"] * HOST_CPU_OVERCOMMIT,
+        int(HOST_MEMORY) if HOST_MEMORY else int(info["MemTotal"] * HOST_MEMORY_OVERCOMMIT),
+    )
+
+class ResourceScheduler:
+    """
+    Placement and admission control for new and restarted containers. Usage is summed
+    from the containers table and the containers still being created, so stopped or
+    removed containers free their share at once.
+    Containers that do not fit on their host are queued and admitted in FIFO order.
+    """
+    def __init__(self, policy: str = PLACEMENT_POLICY):
+        if policy not in ("least-loaded", "hash"):
+            raise ValueError(f"Unknown placement policy: {policy}")
+        self.policy = policy
+        # Capacity per host name, unknown (unlimited) until the host reports it
+        self.capacity: dict[str, HostCapacity] = {}
+        # Admission decisions are serialized so two requests cannot take the same capacity
+        self._lock = asyncio.Lock()
+        # Admitted containers whose image pull and Docker create are still running
+        self._reservations: list[Reservation] = []
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def set_capacity(self, host_name: str, capacity: HostCapacity):
+        self.capacity[host_name] = capacity
+
+    def _capacity(self, host_name: str) -> HostCapacity:
+        return self.capacity.get(host_name) or HostCapacity(float(HOST_CPUS) if HOST_CPUS else None, int(HOST_MEMORY) if HOST_MEMORY else None)
+
+    def _reserved(self, user_id: Optional[int] = None, statuses: tuple[ContainerStatus, ...] = COMMITTED_STATUSES, host_name: Optional[str] = None) -> ResourceUsage:
+        usage = ResourceUsage(0, 0.0, 0)
+        for reservation in self._reservations:
+            if reservation.status in statuses and user_id in (None, reservation.user_id) and host_name in (None, reservation.host_name):
+                usage = usage.add(reservation.limits)
+        return usage
+
+    async def _check_quota(self, db: AsyncSession, user_id: int, limits: ResourceLimits):
+        usage = (await committed_usage(db, user_id)).merge(self._reserved(user_id)).add(limits)
+        if usage.containers > USER_MAX_CONTAINERS:
+            raise QuotaExceededError(f"At most {USER_MAX_CONTAINERS} active containers per user")
+        if usage.cpus > USER_MAX_CPUS or usage.memory > USER_MAX_MEMORY:
+            raise QuotaExceededError(f"Container limits exceed the user quota of {USER_MAX_CPUS:g} CPUs and {USER_MAX_MEMORY // 1024 ** 2} MiB")
+
+    async def _host_state(self, db: AsyncSession, host_name: str, limits: ResourceLimits) -> tuple[bool, int, float]:
+        # Whether the container fits now, how many are queued, and the resulting load
+        queued = (await committed_usage(db, statuses=(ContainerStatus.queued,), docker_host=host_name)).merge(self._reserved(statuses=(ContainerStatus.queued,), host_name=host_name))
+        usage = (await committed_usage(db, docker_host=host_name)).merge(self._reserved(host_name=host_name)).add(limits)
+        capacity = self._capacity(host_name)
+        # Queued containers go first, so a new one may not skip the line
+        return not queued.containers and capacity.fits(usage), queued.containers, capacity.load(usage)
+
+    async def _place(self, db: AsyncSession, user_id: int, limits: ResourceLimits, host_names: list[str]) -> tuple[str, ContainerStatus]:
+        if self.policy == "hash":
+            candidates = rendezvous_order(str(user_id), host_names)
+        else:
+            candidates = host_names
+        states = {name: await self._host_state(db, name, limits) for name in candidates}
+        fitting = [name for name in candidates if states[name][0]]
+        if fitting:
+            if self.policy == "hash":
+                return fitting[0], ContainerStatus.created
+            return min(fitting, key=lambda name: states[name][2]), ContainerStatus.created
+        # Queue on the preferred host that still has room in its queue
+        waiting = [name for name in candidates if states[name][1] < MAX_QUEUED_CONTAINERS]
+        if not waiting:
+            raise CapacityExceededError("Docker hosts are at capacity, try again later")
+        if self.policy == "hash":
+            return waiting[0], ContainerStatus.queued
+        return min(waiting, key=lambda name: (states[name][1], states[name][2])), ContainerStatus.queued
+
+    async def admit(self, db: AsyncSession, user_id: int, limits: ResourceLimits, host_names: list[str], create) -> Container:
+        """
+        Check the user quota, choose a host among host_names and create the container
+        with create(status, host_name), an async callable returning the new row. The
+        status is created, or queued when no host has room. Raises QuotaExceededError
+        or CapacityExceededError when the container is rejected.
+
+        The capacity is reserved under the lock and create runs outside it, so a slow
+        image pull does not hold up other admissions. The reservation is dropped once
+        create has committed the row, or returned if create fails.
+        """
+        if not host_names:
+            raise CapacityExceededError("No Docker host is available")
+        async with self._lock:
+            await self._check_quota(db, user_id, limits)
+            host_name, status = await self._place(db, user_id, limits, host_names)
+            reservation = Reservation(user_id, host_name, status, limits)
+            self._reservations.append(reservation)
+        try:
+            return await create(status, host_name)
+        except BaseException:
+            self.wake()
+            raise
+        finally:
+            self._reservations.remove(reservation)
+
+    async def admit_start(self, container_id: str) -> Optional[Reservation]:
+        """
+        Check that an exited container can be started again on its host and reserve its
+        resources until the caller commits its new status, so a bulk start can save all
+        statuses in one transaction. Returns None when no reservation is needed. Pass the
+        reservation to release() once the status is committed or the start failed.
+        """
+        async with self._lock, AsyncSessionLocal() as db:
+            container = (await db.execute(select(Container).where(Container.container_id == container_id))).scalar_one_or_none()
+            if container is None:
+                return
+            if container.status == ContainerStatus.queued:
+                raise CapacityExceededError("Container is queued until the host has capacity")
+            if container.status != ContainerStatus.exited:
+                return
+            limits = container_limits(container)
+            await self._check_quota(db, container.user_id, limits)
+            fits, _, _ = await self._host_state(db, container.docker_host, limits)
+            if not fits:
+                raise CapacityExceededError("Host is at capacity, try again later")
+            reservation = Reservation(container.user_id, container.docker_host, ContainerStatus.created, limits)
+            self._reservations.append(reservation)
+            return reservation
+
+    def release(self, reservation: Optional[Reservation]):
+        """
+        Drop a reservation of admit_start(), once the container row holds the resources
+        or the start failed.
+        """
+        if reservation is None:
+            return
+        self._reservations.remove(reservation)
+        self.wake()
+
+    def wake(self):
+        """
+        Check the queues now, e.g. after containers were stopped or removed.
+        """
+        self._wake.set()
+
+    async def dispatch(self):
+        """
+        Admit queued containers of each host in order while they fit.
+        """
+        async with self._lock, AsyncSessionLocal() as db:
+            queued = (await db.execute(select(Container).where(Container.status == ContainerStatus.queued).order_by(Container.id))).scalars().all()
+            if not queued:
+                return
+            usage = {}
+            blocked = set()
+            admitted = []
+            for container in queued:
+                if container.docker_host in blocked:
+                    continue
+                if container.docker_host not in usage:
+                    statuses = (ContainerStatus.created, ContainerStatus.running, ContainerStatus.paused)
+                    usage[container.docker_host] = (await committed_usage(db, statuses=statuses, docker_host=container.docker_host)).merge(self._reserved(statuses=statuses, host_name=container.docker_host))
+                next_usage = usage[container.docker_host].add(container_limits(container))
+                if not self._capacity(container.docker_host).fits(next_usage):
+                    blocked.add(container.docker_host)
+                    continue
+                usage[container.docker_host] = next_usage
+                admitted.append(container.id)
+            if admitted:
+                await db.execute(update(Container).where(Container.id.in_(admitted)).values(status=ContainerStatus.created))
+                await db.commit()
+
+    async def _dispatch_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), SCHEDULER_CHECK_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.dispatch()
+            except Exception as e:
+                print(f"Error admitting queued containers: {e}")
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._dispatch_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+scheduler = ResourceScheduler()
@@ -0,0 +1,338 @@
+import asyncio
+import socket
+import ssl
+import time
+from typing import Awaitable, Callable, Optional
+import docker
+from repositories.file_agent import raw_socket
+
+# Bytes read from the exec socket at once
+TERMINAL_READ_BYTES = 64 * 1024
+# Output bursts are sent once this many bytes are buffered or after this many seconds
+TERMINAL_FLUSH_BYTES = 32 * 1024
+TERMINAL_FLUSH_SECONDS = 0.01
+# Reading from the exec socket pauses while this much output waits for a slow client
+TERMINAL_MAX_BUFFERED_BYTES = 1024 * 1024
+# Seconds a session waits for a slow viewer before dropping it
+TERMINAL_SLOW_VIEWER_SECONDS = 10
+
+# Latest output of each session replayed to viewers that attach
+TERMINAL_SCROLLBACK_BYTES = 256 * 1024
+# Seconds a session without viewers keeps its shell running
+TERMINAL_SESSION_GRACE_SECONDS = 300
+# Sessions open at once, sessions without viewers kept, and viewers per session
+TERMINAL_MAX_SESSIONS = 200
+TERMINAL_MAX_DETACHED_SESSIONS = 50
+TERMINAL_MAX_VIEWERS = 8
+
+class TerminalSessionLimitError(Exception):
+    pass
+
+class ExecSocket:
+    """
+    Both directions of an exec started with socket=True. Plain TCP and Unix sockets are
+    driven by the event loop; TLS, SSH and named pipe streams fall back to a thread per call.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        sock = stream._sock if isinstance(stream, socket.SocketIO) else stream
+        if isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket):
+            sock.setblocking(False)
+            self.sock = sock
+        else:
+            self.sock = None
+
+    async def recv(self, size: int = TERMINAL_READ_BYTES) -> bytes:
+        """
+        Read up to size bytes, or b'' once the exec ended.
+        """
+        if self.sock is not None:
+            return await asyncio.get_running_loop().sock_recv(self.sock, size)
+        return await asyncio.to_thread(docker.utils.socket.read, self.stream, size) or b''
+
+    async def send(self, data: bytes):
+        if self.sock is not None:
+            await asyncio.get_running_loop().sock_sendall(self.sock, data)
+        else:
+            await asyncio.to_thread(self.stream.sendall, data)
+
+    def close(self):
+        # SocketIO.close() leaves the socket it wraps open, so close that as well
+        for closable in (self.stream, raw_socket(self.stream)):
+            try:
+                closable.close()
+            except Exception as e:
+                print(f"Error closing exec socket: {e}")
+
+class OutputCoalescer:
+    """
+    Buffers terminal output on its way to a client. Output arriving in a burst is sent
+    in one message per flush window, while a single echo after a pause goes out at once.
+    write() waits while the buffer is full, so a slow client slows down the reader
+    instead of growing the buffer.
+    """
+    def __init__(self, send: Callable[[bytes], Awaitable[None]], flush_bytes: int = TERMINAL_FLUSH_BYTES, flush_seconds: float = TERMINAL_FLUSH_SECONDS, max_buffered: int = TERMINAL_MAX_BUFFERED_BYTES):
+        self.send = send
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.max_buffered = max_buffered
+        self._buffer = bytearray()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._closed = False
+        self._last_flush = 0.0
+
+    def put(self, data: bytes):
+        """
+        Buffer output without waiting for space.
+        """
+        self._buffer += data
+        if len(self._buffer) >= self.max_buffered:
+            self._space.clear()
+        self._ready.set()
+
+    async def write(self, data: bytes, timeout: Optional[float] = None):
+        """
+        Buffer output once there is space. Raises asyncio.TimeoutError if there is
+        still none after timeout seconds.
+        """
+        await asyncio.wait_for(self._space.wait(), timeout)
+        self.put(data)
+
+    def close(self):
+        """
+        Stop accepting output; run() returns once the buffer is sent.
+        """
+        self._closed = True
+        self._ready.set()
+
+    def abort(self):
+        """
+        Drop the buffered output and make run() return.
+        """
+        self._buffer.clear()
+        self.close()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            if not self._closed and len(self._buffer) < self.flush_bytes and time.monotonic() - self._last_flush < self.flush_seconds:
+                # Still in a burst, so let more output gather
+                await asyncio.sleep(self.flush_seconds)
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._ready.clear()
+            self._space.set()
+            if data:
+                await self.send(data)
+                self._last_flush = time.monotonic()
+            if self._closed and not self._buffer:
+                return
+
+class ScrollbackBuffer:
+    """
+    Ring buffer of the latest output of a session. Offsets count every byte written,
+    so a viewer can ask for the output after the last byte it received.
+    """
+    def __init__(self, capacity: int = TERMINAL_SCROLLBACK_BYTES):
+        self.capacity = capacity
+        # Grows up to the capacity, then wraps around
+        self._data = bytearray()
+        self.end = 0
+
+    @property
+    def start(self) -> int:
+        return max(0, self.end - self.capacity)
+
+    def append(self, data: bytes):
+        # Byte at offset n is stored at n % capacity
+        self.end += len(data)
+        if len(data) >= self.capacity:
+            split = self.capacity - self.end % self.capacity
+            data = data[-self.capacity:]
+            self._data = bytearray(data[split:] + data[:split])
+            return
+        position = (self.end - len(data)) % self.capacity
+        if len(self._data) < self.capacity:
+            # Filled in order until it first wraps
+            room = self.capacity - len(self._data)
+            self._data += data[:room]
+            data = data[room:]
+            position = 0
+        self._data[position:position + len(data)] = data
+        if position + len(data) > self.capacity:
+            overflow = position + len(data) - self.capacity
+            del self._data[self.capacity:]
+            self._data[:overflow] = data[-overflow:]
+
+    def read(self, offset: Optional[int] = None) -> bytes:
+        """
+        Output from offset to the end, or all of it when offset is None or has
+        already been overwritten.
+        """
+        start = self.start if offset is None else min(max(offset, self.start), self.end)
+        if start == self.end:
+            return b''
+        first = start % self.capacity
+        last = self.end % self.capacity or self.capacity
+        if first < last:
+            return bytes(self._data[first:last])
+        return bytes(self._data[first:] + self._data[:last])
+
+class TerminalSession:
+    """
+    A shell in a container, shared by any number of viewers. Output is recorded in the
+    scrollback and sent to every viewer; the shell keeps running while no one watches.
+    """
+    def __init__(self, container_id: str, session_id: str, exec_socket: ExecSocket, on_output: Optional[Callable[[], None]] = None, on_close: Optional[Callable[["TerminalSession"], None]] = None, scrollback_bytes: int = TERMINAL_SCROLLBACK_BYTES):
+        self.container_id = container_id
+        self.session_id = session_id
+        self.exec_socket = exec_socket
+        self.scrollback = ScrollbackBuffer(scrollback_bytes)
+        self.viewers: set[OutputCoalescer] = set()
+        self.detached_at: Optional[float] = time.monotonic()
+        self.closed = False
+        self._on_output = on_output
+        self._on_close = on_close
+        self._expiry: Optional[asyncio.TimerHandle] = None
+        self._read_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._read_task = asyncio.get_running_loop().create_task(self._read())
+
+    def info(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "viewers": len(self.viewers),
+            "offset": self.scrollback.end,
+            "scrollback_start": self.scrollback.start,
+            "detached_seconds": time.monotonic() - self.detached_at if self.detached_at is not None else None,
+        }
+
+    def attach(self, viewer: OutputCoalescer, offset: Optional[int] = None):
+        """
+        Add a viewer and queue the scrollback after offset for it.
+        """
+        if len(self.viewers) >= TERMINAL_MAX_VIEWERS:
+            raise TerminalSessionLimitError(f"At most {TERMINAL_MAX_VIEWERS} viewers per terminal session")
+        viewer.put(self.scrollback.read(offset))
+        self.viewers.add(viewer)
+        self.detached_at = None
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+
+    def detach(self, viewer: OutputCoalescer, grace_seconds: float):
+        self.viewers.discard(viewer)
+        if not self.viewers and not self.closed and self.detached_at is None:
+            self.detached_at = time.monotonic()
+            self._expiry = asyncio.get_running_loop().call_later(grace_seconds, self.close)
+
+    async def send(self, data: bytes):
+        await self.exec_socket.send(data)
+
+    async def _read(self):
+        try:
+            while True:
+                output = await self.exec_socket.recv()
+                if not output:
+                    break
+                self.scrollback.append(output)
+                if self._on_output is not None:
+                    self._on_output()
+                for viewer in list(self.viewers):
+                    try:
+                        await viewer.write(output, TERMINAL_SLOW_VIEWER_SECONDS)
+                    except asyncio.TimeoutError:
+                        # A stalled viewer may not hold the shell up for the others
+                        print(f"Dropping slow terminal viewer of {self.container_id}/{self.session_id}")
+                        self.viewers.discard(viewer)
+                        viewer.abort()
+        except Exception as e:
+            print(f"Error reading from container: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        End the shell. Viewers get the output still buffered, then their run() returns.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._expiry is not None:
+            self._expiry.cancel()
+        if self._read_task is not None and self._read_task is not asyncio.current_task():
+            self._read_task.cancel()
+        self.exec_socket.close()
+        for viewer in self.viewers:
+            viewer.close()
+        self.viewers.clear()
+        if self._on_close is not None:
+            self._on_close(self)
+
+class TerminalSessionManager:
+    """
+    Terminal sessions by container and session id. A session outlives its viewers for
+    a grace period so a reconnect gets the same shell back; past the limit on sessions
+    without viewers, the oldest of them are closed first.
+    """
+    def __init__(self, max_sessions: int = TERMINAL_MAX_SESSIONS, max_detached: int = TERMINAL_MAX_DETACHED_SESSIONS, grace_seconds: float = TERMINAL_SESSION_GRACE_SECONDS):
+        self.max_sessions = max_sessions
+        self.max_detached = max_detached
+        self.grace_seconds = grace_seconds
+        self._sessions: dict[tuple[str, str], TerminalSession] = {}
+        self._locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+    def list(self, container_id: str) -> list[TerminalSession]:
+        return [session for (session_container_id, _), session in self._sessions.items() if session_container_id == container_id]
+
+    async def attach(self, container_id: str, session_id: str, viewer: OutputCoalescer, open_exec: Callable[[], Awaitable[ExecSocket]], offset: Optional[int] = None, on_output: Optional[Callable[[], None]] = None) -> TerminalSession:
+        """
+        Attach the viewer to the session, starting its shell with open_exec() if the
+        session does not exist. Raises TerminalSessionLimitError when at a limit.
+        """
+        key = (container_id, session_id)
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            session = self._sessions.get(key)
+            if session is None:
+                if len(self._sessions) >= self.max_sessions:
+                    # Make room by closing the session detached longest
+                    self._evict(self._detached_count() - 1)
+                if len(self._sessions) >= self.max_sessions:
+                    raise TerminalSessionLimitError("Too many terminal sessions, try again later")
+                session = TerminalSession(container_id, session_id, await open_exec(), on_output, self._remove)
+                self._sessions[key] = session
+                session.start()
+            session.attach(viewer, offset)
+            return session
+
+    def detach(self, session: TerminalSession, viewer: OutputCoalescer):
+        session.detach(viewer, self.grace_seconds)
+        self._evict(self.max_detached)
+
+    def _detached_count(self) -> int:
+        return sum(session.detached_at is not None for session in self._sessions.values())
+
+    def _evict(self, keep: int):
+        # Close the sessions detached longest until at most keep are left
+        detached = sorted((session for session in self._sessions.values() if session.detached_at is not None), key=lambda session: session.detached_at)
+        for session in detached[:max(0, len(detached) - keep)]:
+            session.close()
+
+    def _remove(self, session: TerminalSession):
+        key = (session.container_id, session.session_id)
+        if self._sessions.get(key) is session:
+            del self._sessions[key]
+            self._locks.pop(key, None)
+
+    def close_container(self, container_id: str):
+        for session in self.list(container_id):
+            session.close()
+
+    def close_all(self):
+        for session in list(self._sessions.values()):
+            session.close()
+
+terminal_sessions = TerminalSessionManager()
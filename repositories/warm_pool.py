@@ -0,0 +1,144 @@
+import asyncio
+import os
+from collections import deque
+from typing import NamedTuple, Optional
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.container import Container, ContainerStatus
+from repositories.container_events import ContainerEventReconciler
+from repositories.docker_repository import DockerEngine
+from repositories.image_repository import DEFAULT_IMAGE, ImageManager
+from repositories.scheduler import DEFAULT_LIMITS
+
+# Number of idle containers kept ready for new workspaces, capped by the maximum
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "2"))
+WARM_POOL_MAX_SIZE = 32
+# Start pooled containers so a claimed workspace is already booted
+WARM_POOL_START_CONTAINERS = os.environ.get("WARM_POOL_START_CONTAINERS", "true").lower() == "true"
+# Label marking pooled containers, so they can be adopted again after a restart
+WARM_POOL_LABEL = "cenozoic.warm-pool"
+
+class PooledContainer(NamedTuple):
+    container_id: str
+    status: str
+
+class WarmPool:
+    """
+    Pool of pre-created containers of one image. A container is claimed by inserting
+    its row in the containers table, so the unique container_id makes the claim atomic
+    even across processes sharing the pool.
+    """
+    def __init__(self, docker_engine: DockerEngine, images: ImageManager, events: ContainerEventReconciler, host_name: str, image_name: str = DEFAULT_IMAGE, size: int = WARM_POOL_SIZE, start_containers: bool = WARM_POOL_START_CONTAINERS):
+        self.engine = docker_engine
+        self.images = images
+        self.events = events
+        self.host_name = host_name
+        self.image_name = image_name
+        self.size = max(0, min(size, WARM_POOL_MAX_SIZE))
+        self.start_containers = start_containers
+        self._ready: deque[PooledContainer] = deque()
+        self._fill_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        claims = self.hits + self.misses
+        return {
+            "host": self.host_name,
+            "image": self.image_name,
+            "size": self.size,
+            "ready": len(self._ready),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / claims if claims else None,
+            "created": self.created,
+            "failures": self.failures,
+        }
+
+    def _usable(self, pooled: PooledContainer) -> bool:
+        if not self.events.synced:
+            return True
+        # Skip containers that died or were removed while waiting in the pool
+        return self.events.statuses.get(pooled.container_id) == pooled.status
+
+    async def claim(self, db: AsyncSession, user_id: int) -> Optional[Container]:
+        """
+        Assign a ready container to the user and record it. Returns None when the pool
+        is empty; the pool is replenished in the background either way.
+        """
+        try:
+            while self._ready:
+                pooled = self._ready.popleft()
+                if not self._usable(pooled):
+                    continue
+                container = Container(container_id=pooled.container_id, container_name=self.image_name, user_id=user_id, status=ContainerStatus(pooled.status), docker_host=self.host_name, cpu_limit=DEFAULT_LIMITS.cpus, memory_limit=DEFAULT_LIMITS.memory)
+                db.add(container)
+                try:
+                    await db.commit()
+                except IntegrityError:
+                    # Claimed by another process first
+                    await db.rollback()
+                    continue
+                await db.refresh(container)
+                self.hits += 1
+                return container
+            self.misses += 1
+            return None
+        finally:
+            self.replenish()
+
+    def replenish(self):
+        if self.size and (self._fill_task is None or self._fill_task.done()):
+            self._fill_task = asyncio.get_running_loop().create_task(self._fill())
+
+    async def _fill(self):
+        while len(self._ready) < self.size:
+            try:
+                await self.images.ensure(self.image_name)
+                client = await self.engine.get_client()
+                container = await self.engine.run(client.containers.create, self.image_name, labels={WARM_POOL_LABEL: self.image_name}, **DEFAULT_LIMITS.docker_options(), operation="create")
+                status = 'created'
+                if self.start_containers:
+                    await self.engine.run(container.start, operation="start")
+                    status = 'running'
+                self.events.statuses.set(container.id, status)
+                self._ready.append(PooledContainer(container.id, status))
+                self.created += 1
+            except Exception as e:
+                # Try again on the next claim
+                self.failures += 1
+                print(f"Error filling warm pool: {e}")
+                return
+
+    async def _adopt(self, db: AsyncSession):
+        # Reuse unclaimed containers left by a previous run
+        client = await self.engine.get_client()
+        containers = await self.engine.run(client.containers.list, all=True, sparse=True, filters={"label": f"{WARM_POOL_LABEL}={self.image_name}"}, operation="inspect")
+        ids = [container.id for container in containers]
+        claimed = set((await db.execute(select(Container.container_id).where(Container.container_id.in_(ids)))).scalars()) if ids else set()
+        for container in containers:
+            if container.id in claimed:
+                continue
+            if container.status in ('created', 'running') and len(self._ready) < self.size:
+                self._ready.append(PooledContainer(container.id, container.status))
+            else:
+                await self.engine.run(container.remove, force=True, operation="remove")
+
+    async def start(self, db: AsyncSession):
+        try:
+            await self._adopt(db)
+        except Exception as e:
+            print(f"Error adopting warm pool containers: {e}")
+        self.replenish()
+
+    async def stop(self):
+        # Pooled containers are kept and adopted on the next start
+        if self._fill_task is not None:
+            self._fill_task.cancel()
+            try:
+                await self._fill_task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,124 @@
+import time
+import unittest
+from unittest import mock
+import docker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from models.base import Base
+from models.container import Container, ContainerStatus
+from repositories.docker_hosts import DOCKER_HEALTH_CHECK_FAILURES, DockerHostPool
+from repositories.docker_repository import DOCKER_OPERATION_TIMEOUTS
+from repositories.scheduler import HostCapacity, ResourceLimits, ResourceScheduler, rendezvous_order
+from tests.test_docker_repository import HungDaemon, longest_stall
+
+LIMITS = ResourceLimits(1.0, 1024 ** 3)
+
+class FakeDaemon:
+    """
+    Stand-in for the client of one daemon: info() reports its size, or fails while down.
+    """
+    def __init__(self, cpus: int = 4, memory: int = 8 * 1024 ** 3):
+        self.info_result = {"NCPU": cpus, "MemTotal": memory}
+        self.down = False
+
+    def info(self) -> dict:
+        if self.down:
+            raise docker.errors.APIError("daemon unavailable")
+        return self.info_result
+
+def host_pool(names: list[str], scheduler: ResourceScheduler) -> tuple[DockerHostPool, dict[str, FakeDaemon]]:
+    pool = DockerHostPool([(name, f"tcp://{name}:2375") for name in names], scheduler)
+    daemons = {}
+    for name, host in pool.hosts.items():
+        daemons[name] = host.engine._client = FakeDaemon()
+    return pool, daemons
+
+class PlacementTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        self.addAsyncCleanup(engine.dispose)
+        self.session = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def add_containers(self, host_name: str, count: int, user_id: int = 100):
+        async with self.session() as db:
+            for _ in range(count):
+                db.add(Container(container_id=f"{host_name}-{user_id}-{time.monotonic_ns()}", user_id=user_id, status=ContainerStatus.running, docker_host=host_name, cpu_limit=LIMITS.cpus, memory_limit=LIMITS.memory))
+            await db.commit()
+
+    async def place(self, scheduler: ResourceScheduler, user_id: int, host_names: list[str]) -> tuple[ContainerStatus, str]:
+        async def create(status: ContainerStatus, host_name: str):
+            return status, host_name
+        async with self.session() as db:
+            return await scheduler.admit(db, user_id, LIMITS, host_names, create)
+
+    async def test_least_loaded_places_on_the_emptiest_host(self):
+        scheduler = ResourceScheduler("least-loaded")
+        for name in ("a", "b", "c"):
+            scheduler.set_capacity(name, HostCapacity(4.0, 64 * 1024 ** 3))
+        await self.add_containers("a", 2)
+        await self.add_containers("c", 1)
+        self.assertEqual(await self.place(scheduler, 1, ["a", "b", "c"]), (ContainerStatus.created, "b"))
+
+    async def test_hash_keeps_a_user_on_its_host_and_falls_over_when_full(self):
+        scheduler = ResourceScheduler("hash")
+        for name in ("a", "b", "c"):
+            scheduler.set_capacity(name, HostCapacity(2.0, 64 * 1024 ** 3))
+        preferred, second, _ = rendezvous_order("1", ["a", "b", "c"])
+        self.assertEqual(await self.place(scheduler, 1, ["a", "b", "c"]), (ContainerStatus.created, preferred))
+        await self.add_containers(preferred, 2)
+        self.assertEqual(await self.place(scheduler, 1, ["a", "b", "c"]), (ContainerStatus.created, second))
+
+    async def test_unhealthy_hosts_are_not_placed_on(self):
+        scheduler = ResourceScheduler("least-loaded")
+        pool, daemons = host_pool(["a", "b"], scheduler)
+        await self.add_containers("b", 2)
+        daemons["a"].down = True
+        for _ in range(DOCKER_HEALTH_CHECK_FAILURES):
+            for host in pool.hosts.values():
+                await pool.check(host)
+        self.assertEqual(pool.placeable(), ["b"])
+        self.assertEqual(await self.place(scheduler, 1, pool.placeable()), (ContainerStatus.created, "b"))
+
+class HealthCheckTests(unittest.IsolatedAsyncioTestCase):
+    async def test_host_leaves_placement_after_repeated_failures_and_comes_back(self):
+        scheduler = ResourceScheduler()
+        pool, daemons = host_pool(["a", "b"], scheduler)
+        daemons["a"].down = True
+        await pool.check(pool.hosts["a"])
+        # A single failed check is not enough
+        self.assertEqual(pool.placeable(), ["a", "b"])
+        await pool.check(pool.hosts["a"])
+        self.assertEqual(pool.placeable(), ["b"])
+        daemons["a"].down = False
+        await pool.check(pool.hosts["a"])
+        self.assertEqual(pool.placeable(), ["a", "b"])
+
+    async def test_capacity_is_read_from_the_daemon(self):
+        scheduler = ResourceScheduler()
+        pool, daemons = host_pool(["a"], scheduler)
+        daemons["a"].info_result = {"NCPU": 3, "MemTotal": 1024 ** 3}
+        with mock.patch("repositories.scheduler.HOST_CPUS", None), mock.patch("repositories.scheduler.HOST_MEMORY", None), \
+                mock.patch("repositories.scheduler.HOST_CPU_OVERCOMMIT", 2.0), mock.patch("repositories.scheduler.HOST_MEMORY_OVERCOMMIT", 1.0):
+            await pool.check(pool.hosts["a"])
+        self.assertEqual(scheduler.capacity["a"], HostCapacity(6.0, 1024 ** 3))
+
+    async def test_hung_daemon_fails_its_check_without_blocking_the_loop(self):
+        daemon = HungDaemon()
+        self.addCleanup(daemon.close)
+        pool = DockerHostPool([("hung", daemon.url)], ResourceScheduler())
+        host = pool.hosts["hung"]
+        host.engine._client_options["timeout"] = 1
+        self.addCleanup(host.engine.close)
+
+        async def check_twice():
+            for _ in range(DOCKER_HEALTH_CHECK_FAILURES):
+                await pool.check(host)
+
+        with mock.patch.dict(DOCKER_OPERATION_TIMEOUTS, {"inspect": 0.3}):
+            self.assertLess(await longest_stall(check_twice), 0.2)
+        self.assertEqual(pool.placeable(), [])
+
+if __name__ == "__main__":
+    unittest.main()
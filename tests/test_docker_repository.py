@@ -0,0 +1,98 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+from repositories.docker_repository import DOCKER_OPERATION_TIMEOUTS, DockerEngine, DockerTimeoutError
+
+class HungDaemon:
+    """
+    A local socket that accepts connections and never answers, like a wedged daemon.
+    """
+    def __init__(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"tcp://127.0.0.1:{self.server.getsockname()[1]}"
+        self.connections = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                self.connections.append(self.server.accept()[0])
+            except OSError:
+                return
+
+    def close(self):
+        self.server.close()
+        for connection in self.connections:
+            connection.close()
+
+async def longest_stall(work, interval: float = 0.01) -> float:
+    """
+    Run work() and return the longest time the event loop did not get to a ticker.
+    """
+    longest = 0.0
+    done = False
+
+    async def tick():
+        nonlocal longest
+        last = time.monotonic()
+        while not done:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            longest = max(longest, now - last - interval)
+            last = now
+
+    ticker = asyncio.ensure_future(tick())
+    # Let the ticker take its first timestamp before work() can block
+    await asyncio.sleep(0)
+    try:
+        await work()
+    finally:
+        done = True
+        await ticker
+    return longest
+
+class DockerEngineTests(unittest.IsolatedAsyncioTestCase):
+    def engine(self, **options) -> DockerEngine:
+        engine = DockerEngine(**options)
+        self.addCleanup(engine.close)
+        return engine
+
+    async def test_run_times_out(self):
+        engine = self.engine()
+        with mock.patch.dict(DOCKER_OPERATION_TIMEOUTS, {"inspect": 0.1}):
+            with self.assertRaises(DockerTimeoutError):
+                await engine.run(time.sleep, 1, operation="inspect")
+
+    async def test_slow_calls_do_not_block_the_loop_or_the_default_threadpool(self):
+        engine = self.engine(max_workers=2)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        blocked = [asyncio.ensure_future(engine.run(release.wait, 5)) for _ in range(4)]
+        await asyncio.sleep(0.05)
+
+        async def other_work():
+            # Work on the default threadpool goes ahead while the Docker executor is full
+            self.assertEqual(await asyncio.wait_for(asyncio.to_thread(lambda: "done"), 1), "done")
+
+        self.assertLess(await longest_stall(other_work), 0.2)
+        release.set()
+        self.assertEqual(await asyncio.gather(*blocked), [True] * 4)
+
+    async def test_connecting_to_a_hung_daemon_does_not_block_the_loop(self):
+        daemon = HungDaemon()
+        self.addCleanup(daemon.close)
+        engine = self.engine(base_url=daemon.url, timeout=1)
+
+        async def get_containers():
+            for _ in range(2):
+                with self.assertRaises(DockerTimeoutError):
+                    await engine.get_container("x")
+
+        with mock.patch.dict(DOCKER_OPERATION_TIMEOUTS, {"connect": 0.3}):
+            self.assertLess(await longest_stall(get_containers), 0.2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import unittest
+import docker
+from repositories.docker_repository import DockerEngine
+from repositories.image_repository import ImageManager
+
+class FakeImage:
+    def __init__(self, image_id: str):
+        self.id = image_id
+
+class FakeImages:
+    """
+    Stand-in for client.images: get() sees the images pulled so far, pull() blocks
+    until released so tests can overlap requests with a pull.
+    """
+    def __init__(self, local: dict[str, str] = None):
+        self.local = dict(local or {})
+        self.gets = 0
+        self.pulls = 0
+        self.fail_pulls = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def get(self, name: str) -> FakeImage:
+        self.gets += 1
+        if name not in self.local:
+            raise docker.errors.ImageNotFound(name)
+        return FakeImage(self.local[name])
+
+    def pull(self, name: str) -> FakeImage:
+        self.pulls += 1
+        self.release.wait(5)
+        if self.fail_pulls:
+            raise docker.errors.APIError("registry unavailable")
+        self.local[name] = f"sha256:{self.pulls}"
+        return FakeImage(self.local[name])
+
+class FakeClient:
+    def __init__(self, images: FakeImages):
+        self.images = images
+
+def image_manager(images: FakeImages, **options) -> ImageManager:
+    engine = DockerEngine()
+    engine._client = FakeClient(images)
+    return ImageManager(engine, **options)
+
+async def settle(manager: ImageManager):
+    # Wait for the background pulls started so far
+    await asyncio.gather(*manager._pulls.values(), return_exceptions=True)
+
+class ImageManagerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_cold_ensures_share_one_pull(self):
+        images = FakeImages()
+        images.release.clear()
+        manager = image_manager(images)
+        waiters = [asyncio.ensure_future(manager.ensure("app")) for _ in range(20)]
+        await asyncio.sleep(0.05)
+        images.release.set()
+        digests = await asyncio.gather(*waiters)
+        self.assertEqual(images.pulls, 1)
+        self.assertEqual(set(digests), {"sha256:1"})
+
+    async def test_cancelled_request_does_not_cancel_the_shared_pull(self):
+        images = FakeImages()
+        images.release.clear()
+        manager = image_manager(images)
+        first = asyncio.ensure_future(manager.ensure("app"))
+        second = asyncio.ensure_future(manager.ensure("app"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        images.release.set()
+        self.assertEqual(await second, "sha256:1")
+        self.assertEqual(images.pulls, 1)
+
+    async def test_warm_path_does_not_call_the_daemon(self):
+        images = FakeImages()
+        manager = image_manager(images)
+        await manager.ensure("app")
+        gets, pulls = images.gets, images.pulls
+        for _ in range(10):
+            self.assertEqual(await manager.ensure("app"), "sha256:1")
+        self.assertEqual((images.gets, images.pulls), (gets, pulls))
+
+    async def test_local_copy_is_used_without_pulling(self):
+        images = FakeImages({"app": "sha256:local"})
+        manager = image_manager(images)
+        self.assertEqual(await manager.ensure("app"), "sha256:local")
+        self.assertEqual(await manager.ensure("app"), "sha256:local")
+        await settle(manager)
+        self.assertEqual(images.pulls, 0)
+        self.assertEqual(images.gets, 1)
+
+    async def test_stale_copy_is_served_while_refreshed_in_background(self):
+        images = FakeImages({"app": "sha256:local"})
+        manager = image_manager(images, refresh_seconds=0)
+        await manager.ensure("app")
+        images.release.clear()
+        # Served at once from the stale copy while the refresh pull is blocked
+        self.assertEqual(await asyncio.wait_for(manager.ensure("app"), 1), "sha256:local")
+        self.assertEqual(await asyncio.wait_for(manager.ensure("app"), 1), "sha256:local")
+        images.release.set()
+        await settle(manager)
+        self.assertEqual(images.pulls, 1)
+        self.assertEqual(manager.digest("app"), "sha256:1")
+
+    async def test_failed_refresh_backs_off(self):
+        images = FakeImages({"app": "sha256:local"})
+        manager = image_manager(images, refresh_seconds=0, retry_seconds=0.2)
+        images.fail_pulls = True
+        for _ in range(5):
+            self.assertEqual(await manager.ensure("app"), "sha256:local")
+            await settle(manager)
+        self.assertEqual(images.pulls, 1)
+        await asyncio.sleep(0.25)
+        images.fail_pulls = False
+        await manager.ensure("app")
+        await settle(manager)
+        self.assertEqual(images.pulls, 2)
+        self.assertEqual(manager.digest("app"), "sha256:2")
+
+if __name__ == "__main__":
+    unittest.main()